@@ -2,70 +2,1232 @@
 # Banana phone: a surprisingly useful relay API for LM Studio and other LLM platforms
 
 ################### IMPORTS ###################
+# Only what's needed to start serving. Optional features import their extras on first use (tempfile for batches, and
+# tokenizers for configs that name a tokenizer.json).
 import asyncio
-import os, sys, io
-import httpx, h2
-import re, json, csv
+import os
+import httpx
+import re, json
 import logging
-import tempfile
+import logging.handlers
+import queue
+import atexit
+import random
 import time
 import traceback
-import pytz
+import hashlib
+from bisect import bisect_left
 import math
-import shutil
-from fastapi import FastAPI, File, HTTPException, Request, UploadFile, Header, Depends, Query, Response
+from collections import deque
+from fastapi import FastAPI, HTTPException, Request, Header, Query, Response
 from fastapi.responses import Response, StreamingResponse, FileResponse, PlainTextResponse, JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
-from collections import defaultdict 
+from collections import defaultdict, OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from starlette.requests import Request
 from uuid import uuid4
-from pydantic import BaseModel, Field
+from pydantic import BaseModel
 from dotenv import load_dotenv
-from httpx import HTTPStatusError, Timeout
-from datetime import datetime
-from subprocess import run, PIPE
-from typing import Optional, List, Dict
+from httpx import Timeout
+from typing import Optional, List, Dict, Union
+try:
+    import orjson  # Optional; decodes and encodes request and response bodies several times faster than json
+except ImportError:
+    orjson = None
 
 
 ################### ENVIRONMENT VARIABLES ##################
 load_dotenv(dotenv_path='.env')
 
 # Pull in our environment variables as configured in the .env, and define defaults in case that fails. The values here are simply fallback defaults, and not the appropriate place to enter custom values. 
-api_url = os.getenv("DESTINATION_API", "http://localhost:1234") 
+api_url = os.getenv("DESTINATION_API", "http://localhost:1234")  # One or more backends, comma-separated
 endpoint_completions = os.getenv("ENDPOINT_COMPLETIONS", "/v1/chat/completions")
 endpoint_models = os.getenv("ENDPOINT_MODELS", "/v1/models")
+endpoint_embeddings = os.getenv("ENDPOINT_EMBEDDINGS", "/v1/embeddings")
 api_key = os.getenv('API_KEYS').split(',') 
 system_msg = os.getenv("SYSTEM_MSG", "You are a helpful assistant.")
-system_override = os.getenv("SYSTEM_OVERRIDE", False)
-autostyle = os.getenv("AUTOSTYLE", True)
-nostream = os.getenv("NOSTREAM", False)
+system_override = os.getenv("SYSTEM_OVERRIDE", "false").lower() == "true"
+autostyle = os.getenv("AUTOSTYLE", "true").lower() == "true"
+nostream = os.getenv("NOSTREAM", "false").lower() == "true"
+active_model_ttl = float(os.getenv("ACTIVE_MODEL_TTL", 30))  # Seconds before the cached active model is refreshed in the background
+models_path = os.getenv("MODELS_JSON", "models.json")
+models_reload_interval = float(os.getenv("MODELS_RELOAD_INTERVAL", 5))  # Seconds between models.json change checks; 0 disables the watcher
+stream_debug_sample = int(os.getenv("STREAM_DEBUG_SAMPLE", 0))  # Pass every Nth streamed event to the debug hooks; 0 leaves out the logging hook, and any hooks added in code see every event
+enforce_stops = os.getenv("ENFORCE_STOPS", "true").lower() == "true"  # Cut completions at their stop sequences here, in case the backend doesn't
+
+# Streamed delta coalescing, which trades a little latency for fewer writes per stream. Off unless STREAM_COALESCE_MS is set.
+stream_coalesce_window = float(os.getenv("STREAM_COALESCE_MS", 0)) / 1000  # Longest a streamed event is held back to share a write
+stream_coalesce_bytes = int(os.getenv("STREAM_COALESCE_BYTES", 4096))  # Held-back bytes that trigger a write straight away
+stream_coalesce_mode = os.getenv("STREAM_COALESCE_MODE", "merge").lower()  # merge: several events per write; combine: also joins their content into one event
+
+# Context window trimming. models.json configs can set their own contextLength, charsPerToken and tokenizer.
+default_context_length = int(os.getenv("CONTEXT_LENGTH", 0))  # Context length for configs that don't set one; 0 leaves their prompts untrimmed
+chars_per_token = float(os.getenv("CHARS_PER_TOKEN", 3.5))  # Characters per token, for estimating prompt sizes without a tokenizer
+context_reserve = int(os.getenv("CONTEXT_RESERVE", 512))  # Tokens kept free for the reply when a request doesn't set max_tokens
+token_cache_size = int(os.getenv("TOKEN_CACHE_SIZE", 4096))  # Messages whose tokenizer counts are remembered
+
+# Multi-backend routing and health checks
+balance_strategy = os.getenv("BALANCE_STRATEGY", "least_outstanding")  # least_outstanding or ewma
+health_check_interval = float(os.getenv("HEALTH_CHECK_INTERVAL", 10))  # Seconds between active health checks; 0 disables them
+backend_max_failures = int(os.getenv("BACKEND_MAX_FAILURES", 3))  # Consecutive failures before a backend is ejected
+backend_eject_seconds = float(os.getenv("BACKEND_EJECT_SECONDS", 30))  # How long an ejected backend is skipped by routing
+
+# Response cache for deterministic (temperature 0) completions; off unless RESPONSE_CACHE=true
+response_cache_enabled = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+response_cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))  # Most responses kept in memory
+response_cache_ttl = float(os.getenv("RESPONSE_CACHE_TTL", 3600))  # Seconds a cached response stays valid
+response_cache_dir = os.getenv("RESPONSE_CACHE_DIR", "")  # Optional directory for an on-disk tier that survives restarts
+coalesce_requests = os.getenv("COALESCE_REQUESTS", "false").lower() == "true"  # Share one upstream call between identical concurrent requests
+
+# Admission control: caps on concurrent upstream generations, fair queuing between API keys, and rate limits. 0 means unlimited.
+max_concurrent = int(os.getenv("MAX_CONCURRENT", 0))  # Concurrent generations across all keys
+max_concurrent_per_key = int(os.getenv("MAX_CONCURRENT_PER_KEY", 0))  # Concurrent generations for any one key
+queue_max_depth = int(os.getenv("QUEUE_MAX_DEPTH", 100))  # Requests allowed to wait for a slot before new ones are turned away
+queue_max_wait = float(os.getenv("QUEUE_MAX_WAIT", 30))  # Seconds a request may wait for a slot before it's turned away
+rate_limit_rps = float(os.getenv("RATE_LIMIT_RPS", 0))  # Sustained requests per second allowed per key
+rate_limit_burst = float(os.getenv("RATE_LIMIT_BURST", 10))  # Requests a key may make in a burst above its sustained rate
+key_weights = dict((key, float(weight)) for key, _, weight in (entry.partition(':') for entry in os.getenv("KEY_WEIGHTS", "").split(',') if entry))  # key:weight,...
+
+# Upstream connection pool. HTTP/2 is only negotiated over TLS (ALPN); plain http:// backends stay on HTTP/1.1 keepalive.
+upstream_max_connections = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100))
+upstream_max_keepalive = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", 20))
+upstream_keepalive_expiry = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 30))
+upstream_http2 = os.getenv("UPSTREAM_HTTP2", "true").lower() == "true"
+warmup_connections = int(os.getenv("WARMUP_CONNECTIONS", 2))  # Connections opened to each backend at startup, ready for the first requests
+
+# Bulk batches posted to /v1/batch
+batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", 4))  # Batch lines in flight, times the number of healthy backends
+batch_retries = int(os.getenv("BATCH_RETRIES", 2))  # Retries for a batch line that fails or is rate limited
+batch_retry_backoff = float(os.getenv("BATCH_RETRY_BACKOFF", 1))  # Seconds before a line's first retry, doubling after each one
+
+# Embeddings. Concurrent /v1/embeddings requests are gathered into batched upstream calls.
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))  # Most inputs sent upstream in one call
+embedding_batch_wait = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", 5)) / 1000  # Longest an input waits for others to join its batch
+embedding_cache_size = int(os.getenv("EMBEDDING_CACHE_SIZE", 0))  # Recent input vectors remembered; 0 disables the cache
+
+# Logging. Each request gets one summary line; payloads are only logged for a sample of requests, and trimmed.
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+log_payload_sample = float(os.getenv("LOG_PAYLOAD_SAMPLE", 0))  # Fraction of request payloads logged, from 0 to 1
+log_payload_max_chars = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", 1000))  # Logged payloads are cut off after this many characters
+log_redact_prompts = os.getenv("LOG_REDACT_PROMPTS", "true").lower() == "true"  # Log message lengths instead of message text
 
 
 ################### INITIALIZATIONS ###################
-api = FastAPI()
+# Open the shared upstream clients when the app starts, and close them when it stops.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    open_upstream_clients()
+    warmup = asyncio.create_task(warm_up())  # In the background, so /healthz answers while /readyz waits for it
+    watcher = asyncio.create_task(watch_model_config()) if models_reload_interval > 0 else None
+    health_checker = asyncio.create_task(check_backends()) if health_check_interval > 0 else None
+    yield
+    for task in (warmup, watcher, health_checker):
+        if task:
+            task.cancel()
+    await close_upstream_clients()
+
+api = FastAPI(lifespan=lifespan)
 timeout = Timeout(connect=30, read=600, write=120, pool=5)
+discovery_timeout = Timeout(5)  # Model discovery and health checks, so a backend that hangs can't hold up routing
+limits = httpx.Limits(max_connections=upstream_max_connections, max_keepalive_connections=upstream_max_keepalive, keepalive_expiry=upstream_keepalive_expiry)
+upstream_clients: Dict[str, httpx.AsyncClient] = {}  # One pooled client per backend, keyed by base URL
+stream_debug_hooks = []  # Callables given a sample of decoded stream events, every STREAM_DEBUG_SAMPLE events
+model_path_regex = re.compile(r'.*\/([^/]+)\.bin$')
 ALLOWED_IPS = ["127.0.0.1"]  # Include 127.0.0.1 for localhost
-
-logging.basicConfig(level=logging.INFO)
+PROBE_PATHS = ("/healthz", "/readyz")  # Answered without an API key, for load balancers and orchestrators
+warmed_up = False  # Set once startup warmup has compiled models.json and reached the backends
+
+# Log records go onto a queue and a listener thread writes them out, so a slow terminal or log pipe never stalls the event loop
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+logging.basicConfig(level=log_level, handlers=[logging.handlers.QueueHandler(log_queue)], format="%(message)s")
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger("api")
-
-# Load models.json for model auto-configurations
-with open('models.json') as f:
-    model_config_data = json.load(f)
-
-# Extract all model names from the configuration data, compile regex pattern for matching them
-all_models = [model for sublist in [config['models'] for config in model_config_data.values() if 'models' in config] for model in sublist]
-pattern = "|".join(re.escape(model) for model in all_models)  # re.escape to escape any special characters
-regex_pattern = re.compile(pattern)
+request_logger = logging.getLogger("api.requests")  # One summary line per chat completion
+logging.getLogger("httpx").setLevel(max(logging.getLogger().level, logging.WARNING))  # httpx logs every upstream call at INFO; the request summaries cover them
 
 # CLASSES
 class UnexpectedEndpointError(HTTPException):
     def __init__(self, detail: str):
         super().__init__(status_code=400, detail=detail)
 
+# Raised when a client goes away before its response is ready.
+class ClientDisconnected(Exception):
+    pass
+
+# Raised when admission control turns a request away, with a hint of when to try again.
+class AdmissionRejected(HTTPException):
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+# Raised when the destination API answers with an error, to pass its response on as it is.
+class UpstreamError(Exception):
+    def __init__(self, status_code: int, content: bytes):
+        super().__init__(f"Upstream responded with status {status_code}")
+        self.status_code = status_code
+        self.content = content
+
 class CompletionsRequest(BaseModel):
     prompt: str
-    max_tokens: int
+    max_tokens: Optional[int] = None
+    stream: bool = False
+    # Sampling parameters passed through to the chat completion
+    model: Optional[str] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    n: Optional[int] = None
+    stop: Optional[Union[str, List[str]]] = None
+    presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    logit_bias: Optional[Dict[str, float]] = None
+    seed: Optional[int] = None
+    user: Optional[str] = None
+
+# The models.json configurations, plus a compiled index from model shortnames to config names. A reload builds a whole
+# new index and swaps it in, so requests never see a half-loaded file.
+class ModelConfigIndex:
+    def __init__(self, configs: dict, mtime: float = 0.0):
+        self.validate(configs)
+        self.configs = configs
+        self.mtime = mtime
+        self.shortnames = {}  # shortname -> config name; the first config in the file wins a duplicate shortname
+        self._matches = {}  # model id -> config name
+        for config_name, config_data in configs.items():
+            for model_name in config_data.get('models', []):
+                if not model_name:
+                    continue
+                if self.shortnames.get(model_name, config_name) != config_name:
+                    logger.warning(f"Model name '{model_name}' is listed under both '{self.shortnames[model_name]}' and '{config_name}'. Using '{self.shortnames[model_name]}'.")
+                self.shortnames.setdefault(model_name, config_name)
+
+        # A lookahead finds a match starting at every position, and trying longer alternatives first makes each one the longest
+        names = sorted(self.shortnames, key=len, reverse=True)
+        self.regex = re.compile("(?=(" + "|".join(re.escape(name) for name in names) + "))") if names else None
+
+    # Check the shape of every configuration up front, so a typo fails the load with a clear message rather than failing
+    # requests later. Raises ValueError listing every problem found.
+    @staticmethod
+    def validate(configs: dict):
+        if not isinstance(configs, dict):
+            raise ValueError("models.json must be an object of named configurations.")
+        problems = []
+        for config_name, config_data in configs.items():
+            if not isinstance(config_data, dict):
+                problems.append(f"'{config_name}' is not an object")
+                continue
+            for field in ('prefix', 'suffix'):
+                if not isinstance(config_data.get(field), str):
+                    problems.append(f"'{config_name}' needs a string '{field}'")
+            for field in ('sysPrefix', 'sysSuffix', 'tokenizer'):
+                if field in config_data and not isinstance(config_data[field], str):
+                    problems.append(f"'{config_name}' has a non-string '{field}'")
+            for field in ('models', 'stops'):
+                value = config_data.get(field, [])
+                if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                    problems.append(f"'{config_name}' needs '{field}' to be a list of strings")
+            if 'contextLength' in config_data and not (isinstance(config_data['contextLength'], int) and config_data['contextLength'] >= 0):
+                problems.append(f"'{config_name}' needs 'contextLength' to be a whole number of tokens")
+            if 'charsPerToken' in config_data and not (isinstance(config_data['charsPerToken'], (int, float)) and config_data['charsPerToken'] > 0):
+                problems.append(f"'{config_name}' needs 'charsPerToken' to be a positive number")
+        if problems:
+            raise ValueError("Invalid model configuration: " + "; ".join(problems) + ".")
+
+    @classmethod
+    def from_file(cls, path: str) -> "ModelConfigIndex":
+        mtime = os.path.getmtime(path)
+        with open(path) as f:
+            return cls(json.load(f), mtime)
+
+    # Return the config whose shortname is the longest match within the model id (earliest match breaks ties).
+    def match(self, model_id: str) -> str:
+        config_name = self._matches.get(model_id)
+        if config_name is None:
+            config_name = self._match(model_id)
+            if len(self._matches) >= 1024:
+                self._matches.clear()
+            self._matches[model_id] = config_name
+        return config_name
+
+    def _match(self, model_id: str) -> str:
+        best = None
+        if self.regex:
+            for match in self.regex.finditer(model_id):
+                if best is None or len(match.group(1)) > len(best):
+                    best = match.group(1)
+        if best is None:
+            logger.warning(f"Model name {model_id} does not match any configuration. Using default.")
+            return "default"  # Return the default configuration key if no match found
+        logger.info(f"Match found for model '{best}' under configuration '{self.shortnames[best]}'")
+        return self.shortnames[best]
+
+# Load models.json for model auto-configurations
+model_index = ModelConfigIndex.from_file(models_path)
+
+# Caches a backend's active model. Stale entries are still served while a single background refresh runs, and concurrent
+# misses share one upstream lookup. The config name is matched on read, so a models.json reload applies at once.
+class ActiveModelCache:
+    def __init__(self, ttl: float, backend: "Backend"):
+        self.ttl = ttl
+        self.backend = backend
+        self.model_id = None
+        self.fetched_at = 0.0
+        self._inflight = None
+
+    def is_fresh(self) -> bool:
+        return self.model_id is not None and time.monotonic() - self.fetched_at < self.ttl
+
+    async def get(self) -> str:
+        if self.model_id is None:
+            return await self.refresh()
+        if not self.is_fresh():
+            self._start_refresh()
+        return match_model_config(self.model_id)
+
+    async def refresh(self) -> str:
+        return await asyncio.shield(self._start_refresh())
+
+    def invalidate(self):
+        self.model_id = None
+        self.fetched_at = 0.0
+
+    # Drop the cached entry if a backend response reports a different model than the one we cached. A model the backend
+    # already lists is one of the models it serves, e.g. one asked for by name, so it leaves the cache alone.
+    def observe(self, reported_model: str):
+        if not reported_model or not self.model_id or self.backend.serves(reported_model):
+            return
+        if model_basename(reported_model) != model_basename(self.model_id):
+            logger.info(f"Active model changed from {self.model_id} to {reported_model}; invalidating cache.")
+            self.invalidate()
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch())
+        return self._inflight
+
+    async def _fetch(self) -> str:
+        model_ids = await fetch_backend_models(self.backend)
+        if not model_ids:
+            # Keep serving the last good value; don't cache failures
+            return match_model_config(self.model_id) if self.model_id else "default"
+        self.model_id = model_ids[0]
+        self.fetched_at = time.monotonic()
+        return match_model_config(self.model_id)
+
+# One destination API, with the routing and health state used to pick between several of them.
+class Backend:
+    def __init__(self, url: str):
+        self.url = url
+        self.active_model = ActiveModelCache(active_model_ttl, self)
+        self.models = []  # Model ids served, as last reported by ENDPOINT_MODELS
+        self._model_names = set()  # The same ids, plus their names without folder paths and .bin
+        self.outstanding = 0
+        self.ewma_latency = 0.0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.generation_seconds = 0.0  # Moving average of how long a completed generation takes
+        self.abandoned = 0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def set_models(self, model_ids: list):
+        self.models = model_ids
+        self._model_names = set(model_ids) | {model_basename(model_id) for model_id in model_ids}
+
+    def serves(self, model: str) -> bool:
+        return model in self._model_names or model_basename(model) in self._model_names
+
+    # Count a request against this backend while it runs. Yields a callback to record the response status once it arrives.
+    @asynccontextmanager
+    async def track(self):
+        self.outstanding += 1
+        started = time.monotonic()
+
+        def responded(status_code: int):
+            if status_code >= 500:
+                self.record_failure()
+            else:
+                self.record_success(time.monotonic() - started)
+
+        try:
+            yield responded
+        except httpx.TransportError:
+            self.record_failure()
+            raise
+        finally:
+            self.outstanding -= 1
+
+    def record_success(self, latency: float = None):
+        self.failures = 0
+        self.ejected_until = 0.0
+        if latency is not None:
+            self.ewma_latency = latency if not self.ewma_latency else 0.3 * latency + 0.7 * self.ewma_latency
+
+    # Note a generation that ran to completion, to estimate how much an abandoned one would have gone on to use.
+    def record_generation(self, seconds: float):
+        self.generation_seconds = seconds if not self.generation_seconds else 0.3 * seconds + 0.7 * self.generation_seconds
+
+    # Note a generation cancelled because its client went away, and how much backend time that likely freed up.
+    def record_abandoned(self, elapsed: float, streaming: bool):
+        self.abandoned += 1
+        stream_label = "true" if streaming else "false"
+        metrics["abandoned_generations"].inc(self.url, stream_label)
+        metrics["abandoned_seconds"].inc(self.url, stream_label, amount=elapsed)
+        metrics["reclaimed_seconds"].inc(self.url, stream_label, amount=max(0.0, self.generation_seconds - elapsed))
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= backend_max_failures and self.healthy:
+            logger.warning(f"Ejecting backend {self.url} for {backend_eject_seconds}s after {self.failures} consecutive failures.")
+            self.ejected_until = time.monotonic() + backend_eject_seconds
+
+    def status(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "models": self.models,
+            "active_model": self.active_model.model_id,
+            "outstanding": self.outstanding,
+            "ewma_latency": round(self.ewma_latency, 4),
+            "generation_seconds": round(self.generation_seconds, 4),
+            "failures": self.failures,
+            "abandoned": self.abandoned,
+        }
+
+
+################### UPSTREAM CLIENTS ###################
+# Decode and encode JSON bodies, with orjson when it's installed. orjson only handles 64-bit integers: it decodes longer
+# ones as floats and won't encode them, so anything that might hold one goes through json instead, to arrive unchanged.
+long_integer_regex = re.compile(rb'\d{19}')
+
+def json_loads(data: Union[bytes, str]):
+    if not orjson or long_integer_regex.search(data.encode() if isinstance(data, str) else data):
+        return json.loads(data)
+    return orjson.loads(data)
+
+def json_bytes(obj) -> bytes:
+    if orjson:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj).encode()
+
+# Make sure a backend URL has a scheme, since LM Studio addresses are often entered as bare host:port.
+def normalize_backend_url(url: str) -> str:
+    return url if url.startswith(('http://', 'https://')) else 'http://' + url
+
+def open_upstream_clients():
+    for backend in backends:
+        get_upstream_client(backend.url)
+
+async def close_upstream_clients():
+    clients = list(upstream_clients.values())
+    upstream_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+# Return the shared client for a backend, creating it on first use (e.g. when the app runs without its lifespan).
+def get_upstream_client(base_url: str = None) -> httpx.AsyncClient:
+    base_url = normalize_backend_url(base_url or backends[0].url)
+    client = upstream_clients.get(base_url)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(http2=upstream_http2, limits=limits, timeout=timeout)
+        upstream_clients[base_url] = client
+    return client
+
+# Summarize the connection pool of each backend client. httpx doesn't expose this publicly, so we read httpcore's pool.
+def upstream_pool_stats() -> dict:
+    stats = {}
+    for base_url, client in upstream_clients.items():
+        pool = getattr(client._transport, '_pool', None)
+        connections = list(getattr(pool, 'connections', []))
+        stats[base_url] = {
+            "http2": upstream_http2,
+            "max_connections": upstream_max_connections,
+            "max_keepalive_connections": upstream_max_keepalive,
+            "keepalive_expiry": upstream_keepalive_expiry,
+            "connections": len(connections),
+            "idle": sum(1 for conn in connections if conn.is_idle()),
+            "active": sum(1 for conn in connections if not conn.is_idle() and not conn.is_closed()),
+            "http2_connections": sum(1 for conn in connections if getattr(conn, '_connection', None).__class__.__name__ == 'AsyncHTTP2Connection'),
+            "in_flight_requests": len(getattr(pool, '_requests', [])),
+            "queued_requests": sum(1 for req in getattr(pool, '_requests', []) if req.is_queued()),
+        }
+    return stats
+
+
+################### BACKENDS ###################
+backends = [Backend(normalize_backend_url(url.strip())) for url in api_url.split(',') if url.strip()]
+backend_rotation = 0  # Rotates the order backends are considered in, so ties don't always land on the first one
+
+# Pick the backend for a request: among healthy backends serving the requested model (or all healthy backends, if none
+# report serving it), the one with the fewest outstanding requests, or the lowest expected latency under BALANCE_STRATEGY=ewma.
+def select_backend(model: str = None) -> Backend:
+    global backend_rotation
+    candidates = [backend for backend in backends if backend.healthy]
+    if not candidates:
+        logger.warning("All backends are ejected; routing to the least loaded one anyway.")
+        candidates = backends
+    if model:
+        serving = [backend for backend in candidates if backend.serves(model)]
+        if serving:
+            candidates = serving
+
+    backend_rotation = (backend_rotation + 1) % len(candidates)
+    candidates = candidates[backend_rotation:] + candidates[:backend_rotation]
+    if balance_strategy == "ewma":
+        return min(candidates, key=lambda backend: (backend.ewma_latency * (backend.outstanding + 1), backend.outstanding))
+    return min(candidates, key=lambda backend: (backend.outstanding, backend.ewma_latency))
+
+
+# Ask a backend which models it serves. Doubles as the health check: success or failure is recorded on the backend.
+# Returns None on error so the caller can fall back.
+async def fetch_backend_models(backend: Backend) -> Optional[list]:
+    client = get_upstream_client(backend.url)
+    log_error = logger.error if backend.failures == 0 else logger.debug  # A backend that stays down is reported once, not every check
+    try:
+        response = await client.get(f'{backend.url}{endpoint_models}', timeout=discovery_timeout)
+        response.raise_for_status()  # Raises an HTTPError for bad responses (4xx and 5xx)
+        model_ids = [model["id"] for model in json.loads(response.content)["data"]]
+        if model_ids != backend.models:
+            logger.info(f"Models served by {backend.url}: {model_ids}")
+        logger.debug(f"Models fetched from {backend.url}: {model_ids}")
+        backend.set_models(model_ids)
+        backend.record_success()
+        return model_ids
+    except httpx.HTTPError as http_err:
+        log_error(f"HTTP error fetching models from {backend.url}: {http_err!r}")
+    except (KeyError, TypeError) as key_err:
+        log_error(f"Key error in parsing models from {backend.url}: {key_err!r}")
+    except json.JSONDecodeError as json_err:
+        log_error(f"JSON decode error in models from {backend.url}: {json_err}")
+    except Exception as e:
+        log_error(f"Unexpected error fetching models from {backend.url}: {e!r}")
+    backend.record_failure()
+    return None
+
+
+# Periodically re-discover each backend's models, which also refreshes its active model and health.
+async def check_backends():
+    while True:
+        await asyncio.sleep(health_check_interval)
+        await asyncio.gather(*(backend.active_model.refresh() for backend in backends), return_exceptions=True)
+
+
+################### RESPONSE CACHE ###################
+# An LRU of completion responses, bounded by entry count and age, with an optional on-disk tier behind it. The disk tier
+# keeps the most recently written max_entries responses, deleting older files as new ones are written.
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl: float, directory: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> (stored_at, response); stored_at is wall-clock time so it means the same on disk
+        self.disk_keys = OrderedDict()  # keys with a file on disk, oldest written first
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "disk_evictions": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._scan_disk()
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None and self.directory:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is None:
+                self.disk_keys.pop(key, None)
+            else:
+                self.stats["disk_hits"] += 1
+                self._remember(key, entry)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            if entry is not None:
+                self.entries.pop(key, None)
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    async def put(self, key: str, response: dict):
+        entry = (time.time(), response)
+        self._remember(key, entry)
+        self.stats["stores"] += 1
+        if self.directory:
+            await asyncio.to_thread(self._write_disk, key, entry)
+            self.disk_keys[key] = entry[0]
+            self.disk_keys.move_to_end(key)
+            evicted = []
+            while len(self.disk_keys) > self.max_entries:
+                evicted.append(self.disk_keys.popitem(last=False)[0])
+                self.stats["disk_evictions"] += 1
+            if evicted:
+                await asyncio.to_thread(self._remove_disk, evicted)
+
+    def _remember(self, key: str, entry: tuple):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    # Index the files left by earlier runs, oldest first, deleting expired ones, leftover temp files, and any past max_entries.
+    def _scan_disk(self):
+        now = time.time()
+        stale = []
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if name.endswith('.json') and now - mtime <= self.ttl:
+                found.append((mtime, name[:-len('.json')]))
+            elif name.endswith(('.json', '.tmp')):
+                stale.append(path)
+        found.sort()
+        excess = max(0, len(found) - self.max_entries)
+        stale.extend(self._path(key) for _, key in found[:excess])
+        self.disk_keys = OrderedDict((key, mtime) for mtime, key in found[excess:])
+        for path in stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        try:
+            with open(self._path(key)) as f:
+                stored = json.load(f)
+            stored_at, response = stored["stored_at"], stored["response"]
+        except OSError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            self._remove_disk([key])  # Unreadable, so it would never be served
+            return None
+        if time.time() - stored_at > self.ttl:
+            self._remove_disk([key])
+            return None
+        return stored_at, response
+
+    def _remove_disk(self, keys: list):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _write_disk(self, key: str, entry: tuple):
+        temp_path = f"{self._path(key)}.{uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({"stored_at": entry[0], "response": entry[1]}, f)
+            os.replace(temp_path, self._path(key))  # Atomic, so a reader never sees half a file
+        except OSError as e:
+            logger.error(f"Could not write response cache entry to {self.directory}: {e}")
+
+    def status(self) -> dict:
+        return {**self.stats, "entries": len(self.entries), "disk_entries": len(self.disk_keys), "max_entries": self.max_entries, "ttl": self.ttl, "directory": self.directory or None}
+
+response_cache = ResponseCache(response_cache_size, response_cache_ttl, response_cache_dir) if response_cache_enabled else None
+
+
+# Hash a payload as it will be sent upstream, minus the fields that don't change the completion, plus the model.
+def payload_key(payload: dict, model: str = None) -> str:
+    significant = {field: value for field, value in payload.items() if field not in ('stream', 'user')}
+    canonical = json.dumps([model, significant], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# Only deterministic requests are worth caching; anything sampled at a temperature above 0 should vary between calls.
+def is_cacheable(payload: dict) -> bool:
+    return payload.get('temperature') == 0 and payload.get('n', 1) == 1
+
+
+# The model a backend will actually run for a request, so cache entries from one model are never served for another.
+async def resolve_model_id(backend: Backend, requested_model: str = None) -> Optional[str]:
+    if requested_model and backend.serves(requested_model):
+        return requested_model
+    await backend.active_model.get()
+    return backend.active_model.model_id
+
+
+################### REQUEST COALESCING ###################
+# Replays one upstream stream to any number of subscribers. Late joiners get every event received so far, then the live
+# events as they arrive. The upstream request is cancelled if every subscriber disconnects before it finishes.
+class StreamBroadcaster:
+    def __init__(self, source):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for event in source:
+                self.events.append(event)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            await source.aclose()
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    # Register a subscriber right away, so a flight with a pending response isn't cancelled for having no listeners.
+    def subscribe(self):
+        self.subscribers += 1
+        return self._replay()
+
+    async def _replay(self):
+        sent = 0
+        try:
+            while True:
+                if sent < len(self.events):
+                    chunk = b''.join(self.events[sent:])  # A late joiner catches up in a single write
+                    sent = len(self.events)
+                    yield chunk
+                elif self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                logger.info("All subscribers to a coalesced stream disconnected; cancelling the upstream request.")
+                self.task.cancel()
+
+
+# Attaches identical concurrent requests to the first one's upstream call, for both streaming and regular responses.
+class RequestCoalescer:
+    def __init__(self):
+        self.calls = {}  # key -> [task, waiter count]
+        self.streams = {}  # key -> StreamBroadcaster
+        self.stats = {"upstream_calls": 0, "coalesced": 0}
+
+    async def call(self, key: str, send):
+        flight = self.calls.get(key)
+        if flight is None:
+            flight = self.calls[key] = [asyncio.create_task(send()), 0]
+            flight[0].add_done_callback(lambda task: self._forget(self.calls, key, flight))
+            self.stats["upstream_calls"] += 1
+        else:
+            self.stats["coalesced"] += 1
+
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not flight[0].done():
+                flight[0].cancel()  # Nobody is waiting for this response any more
+
+    def in_flight(self, key: str, streaming: bool) -> bool:
+        if streaming:
+            return key in self.streams and not self.streams[key].done
+        return key in self.calls
+
+    def stream(self, key: str, open_stream):
+        broadcaster = self.streams.get(key)
+        if broadcaster is None or broadcaster.done:
+            broadcaster = self.streams[key] = StreamBroadcaster(open_stream())
+            broadcaster.task.add_done_callback(lambda task: self._forget(self.streams, key, broadcaster))
+            self.stats["upstream_calls"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        return broadcaster.subscribe()
+
+    @staticmethod
+    def _forget(flights: dict, key: str, flight):
+        if flights.get(key) is flight:
+            del flights[key]
+
+    def status(self) -> dict:
+        return {**self.stats, "in_flight_calls": len(self.calls), "in_flight_streams": len(self.streams)}
+
+coalescer = RequestCoalescer() if coalesce_requests else None
+
+
+################### EMBEDDINGS ###################
+# Gathers the text inputs of concurrent embeddings requests into one upstream call per batch, and hands each caller back
+# its own vectors. A batch goes out once it holds EMBEDDING_BATCH_SIZE inputs, or EMBEDDING_BATCH_WAIT_MS after its first
+# input arrived. Inputs repeated within a batch are embedded once, and recent vectors can be kept in an LRU.
+class EmbeddingBatcher:
+    def __init__(self, max_batch: int, max_wait: float, cache_size: int):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (batch key, text) -> (vector, prompt tokens, model)
+        self.pending = {}  # batch key -> {text: future}
+        self.timers = {}  # batch key -> timer that sends the batch when its wait is up
+        self.sending = set()  # Batches on their way upstream, referenced until they finish
+        self.stats = {"inputs": 0, "cache_hits": 0, "deduplicated": 0, "upstream_calls": 0}
+
+    # Embed texts with one model and set of options. Returns a (vector, prompt tokens, model) for each text, in order.
+    # Inputs only share a batch with others for the same model and options, e.g. the same encoding_format.
+    async def embed(self, model: Optional[str], options: dict, texts: list) -> list:
+        key = (model, json.dumps(options, sort_keys=True))
+        results = [None] * len(texts)
+        waiting = []
+        for index, text in enumerate(texts):
+            self.stats["inputs"] += 1
+            cached = self._cached(key, text)
+            if cached is not None:
+                results[index] = cached
+            else:
+                waiting.append((index, self._enqueue(key, text)))
+
+       # Shielded, so a caller that goes away doesn't cancel vectors another caller is waiting on too
+        embedded = await asyncio.gather(*(asyncio.shield(future) for _, future in waiting), return_exceptions=True)
+        for (index, _), result in zip(waiting, embedded):
+            if isinstance(result, BaseException):
+                raise result
+            results[index] = result
+        return results
+
+    def _cached(self, key: tuple, text: str) -> Optional[tuple]:
+        if not self.cache_size:
+            return None
+        result = self.cache.get((key, text))
+        if result is not None:
+            self.cache.move_to_end((key, text))
+            self.stats["cache_hits"] += 1
+        return result
+
+    def _remember(self, key: tuple, text: str, result: tuple):
+        if not self.cache_size:
+            return
+        self.cache[(key, text)] = result
+        self.cache.move_to_end((key, text))
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _enqueue(self, key: tuple, text: str) -> asyncio.Future:
+        batch = self.pending.setdefault(key, {})
+        future = batch.get(text)
+        if future is not None:
+            self.stats["deduplicated"] += 1
+            return future
+        future = batch[text] = asyncio.get_running_loop().create_future()
+        if len(batch) >= self.max_batch:
+            self._send(key)
+        elif key not in self.timers:
+            self.timers[key] = asyncio.get_running_loop().call_later(self.max_wait, self._send, key)
+        return future
+
+    def _send(self, key: tuple):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if batch:
+            task = asyncio.create_task(self._embed_batch(key, batch))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    # Send one batch upstream and scatter its vectors back to the waiting callers.
+    async def _embed_batch(self, key: tuple, batch: dict):
+        model, options = key
+        texts = list(batch)
+        payload = {**json.loads(options), "input": texts}
+        if model:
+            payload["model"] = model
+        self.stats["upstream_calls"] += 1
+        metrics["embedding_batch_size"].observe(len(texts))
+        try:
+            backend = select_backend(model)
+            async with backend.track() as responded:
+                response = await get_upstream_client(backend.url).post(f'{backend.url}{endpoint_embeddings}', content=json_bytes(payload), headers={"content-type": "application/json"})
+                responded(response.status_code)
+            if 400 <= response.status_code < 500 and len(texts) > 1:
+               # Probably one bad input, like one too long for the model; send them one at a time so only it fails
+                await asyncio.gather(*(self._embed_batch(key, {text: future}) for text, future in batch.items()))
+                return
+            if response.status_code != 200:
+                raise UpstreamError(response.status_code, response.content)
+
+            body = json_loads(response.content)
+            vectors = {item['index']: item['embedding'] for item in body['data']}
+            prompt_tokens = (body.get('usage') or {}).get('prompt_tokens') or 0
+            total_chars = sum(len(text) for text in texts) or 1
+            for index, (text, future) in enumerate(batch.items()):
+                result = (vectors[index], round(prompt_tokens * len(text) / total_chars), body.get('model') or model)  # Usage is shared out by input length
+                self._remember(key, text, result)
+                if not future.done():
+                    future.set_result(result)
+        except Exception as exc:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(exc)
+
+embedding_batcher = EmbeddingBatcher(embedding_batch_size, embedding_batch_wait, embedding_cache_size)
+
+
+# Send an embeddings request on as it is, for inputs the batcher doesn't handle, like token arrays.
+async def relay_embeddings(body: bytes, model: str = None) -> Response:
+    backend = select_backend(model)
+    async with backend.track() as responded:
+        response = await get_upstream_client(backend.url).post(f'{backend.url}{endpoint_embeddings}', content=body, headers={"content-type": "application/json"})
+        responded(response.status_code)
+    return Response(content=response.content, status_code=response.status_code, media_type="application/json")
+
+
+################### ADMISSION CONTROL ###################
+# Per-key scheduling state: waiting requests, running generations, weighted virtual time and a rate limit token bucket.
+class KeyState:
+    def __init__(self, weight: float, burst: float):
+        self.weight = weight
+        self.waiters = deque()
+        self.active = 0
+        self.vtime = 0.0
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.admitted = 0
+        self.rejected = 0
+
+
+# Caps concurrent upstream generations globally and per API key. Excess requests wait in per-key queues served by start-time
+# fair queuing, so each backlogged key gets slots in proportion to its weight, and a busy key can't starve the others.
+class AdmissionScheduler:
+    def __init__(self, max_active: int, max_active_per_key: int, max_queued: int, max_wait: float, rate: float, burst: float, weights: dict):
+        self.max_active = max_active
+        self.max_active_per_key = max_active_per_key
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.rate = rate
+        self.burst = burst
+        self.weights = weights
+        self.keys = {}
+        self.active = 0
+        self.queued = 0
+        self.vtime = 0.0
+        self.ewma_hold = 1.0  # Typical seconds a slot is held, for Retry-After estimates
+
+    def _state(self, key: str) -> KeyState:
+        state = self.keys.get(key)
+        if state is None:
+            state = self.keys[key] = KeyState(self.weights.get(key, 1.0), self.burst)
+        return state
+
+    def _retry_after(self) -> float:
+        capacity = self.max_active or self.active or 1
+        return self.ewma_hold * (self.queued + 1) / capacity
+
+    def _reject(self, state: KeyState, detail: str, retry_after: float):
+        state.rejected += 1
+        raise AdmissionRejected(detail, retry_after)
+
+    def _take_token(self, state: KeyState):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        state.tokens = min(self.burst, state.tokens + (now - state.refilled_at) * self.rate)
+        state.refilled_at = now
+        if state.tokens < 1:
+            self._reject(state, "Rate limit exceeded.", (1 - state.tokens) / self.rate)
+        state.tokens -= 1
+
+    # Wait for a generation slot. Returns a slot to hand back to release(); raises AdmissionRejected if the request is
+    # over its rate limit, the queue is full, or the wait runs past QUEUE_MAX_WAIT.
+    async def acquire(self, key: str) -> tuple:
+        state = self._state(key)
+        self._take_token(state)
+        if self.queued >= self.max_queued and not self._shed_for(state):
+            self._reject(state, "Too many requests are queued. Try again later.", self._retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        if not state.waiters:
+            state.vtime = max(state.vtime, self.vtime)  # A newly backlogged key starts from the current virtual time
+        state.waiters.append(waiter)
+        self.queued += 1
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # Granted just as we gave up: keep it if we timed out, hand it back if we were cancelled
+                if isinstance(e, asyncio.TimeoutError):
+                    return state, waiter.result()
+                self.release((state, waiter.result()))
+                raise
+            waiter.cancel()
+            state.waiters.remove(waiter)
+            self.queued -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject(state, "Timed out waiting for a free generation slot.", self._retry_after())
+            raise
+        return state, waiter.result()
+
+    # When the queue is full, make room for a key by turning away the newest request of the key with the longest queue,
+    # so one busy key can't fill the queue and lock everyone else out. Returns False if this key already queues the most.
+    def _shed_for(self, state: KeyState) -> bool:
+        longest = max(self.keys.values(), key=lambda other: len(other.waiters))
+        if len(longest.waiters) <= len(state.waiters) + 1:
+            return False
+        waiter = longest.waiters.pop()
+        self.queued -= 1
+        longest.rejected += 1
+        waiter.set_exception(AdmissionRejected("Too many requests are queued. Try again later.", self._retry_after()))
+        return True
+
+    def release(self, slot: tuple):
+        state, granted_at = slot
+        state.active -= 1
+        self.active -= 1
+        self.ewma_hold = 0.2 * (time.monotonic() - granted_at) + 0.8 * self.ewma_hold
+        self._dispatch()
+
+    # Hand free slots to waiting requests, taking the eligible key with the earliest virtual time each time.
+    def _dispatch(self):
+        while self.queued and (self.max_active <= 0 or self.active < self.max_active):
+            eligible = [state for state in self.keys.values() if state.waiters and (self.max_active_per_key <= 0 or state.active < self.max_active_per_key)]
+            if not eligible:
+                return
+            state = min(eligible, key=lambda state: state.vtime)
+            waiter = state.waiters.popleft()
+            self.queued -= 1
+            self.vtime = state.vtime
+            state.vtime += 1 / state.weight
+            state.active += 1
+            state.admitted += 1
+            self.active += 1
+            waiter.set_result(time.monotonic())
+
+    # Release the slot once a streamed response finishes, however it finishes.
+    async def hold(self, slot: tuple, stream):
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.release(slot)
+
+    def status(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_active": self.max_active,
+            "max_active_per_key": self.max_active_per_key,
+            "max_queued": self.max_queued,
+            "keys": {redact_key(key): {"weight": state.weight, "active": state.active, "queued": len(state.waiters), "admitted": state.admitted, "rejected": state.rejected} for key, state in self.keys.items()},
+        }
+
+admission = AdmissionScheduler(max_concurrent, max_concurrent_per_key, queue_max_depth, queue_max_wait, rate_limit_rps, rate_limit_burst, key_weights) if max_concurrent or max_concurrent_per_key or rate_limit_rps else None
+
+
+# The API key a request is scheduled under; without API keys, requests are told apart by client address.
+def client_key(request: Request) -> str:
+    scheme, _, token = request.headers.get("Authorization", "").partition(' ')
+    if scheme.lower() == 'bearer' and token:
+        return token
+    return request.client.host if request.client else "anonymous"
+
+
+# Show just enough of an API key to tell keys apart, without revealing it.
+def redact_key(key: str) -> str:
+    return f"{key[:4]}…{hashlib.sha256(key.encode()).hexdigest()[:6]}"
+
+
+################### METRICS ###################
+# Prometheus-style metrics, kept as plain counters and fixed-bucket arrays so recording stays cheap on the streaming path.
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = defaultdict(float)  # label values -> value
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] += amount
+
+    def render(self) -> list:
+        return [f"{self.name}{format_labels(self.labels, label_values)} {value}" for label_values, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        self.values[label_values] = value
+
+    def dec(self, *label_values, amount: float = 1):
+        self.values[label_values] -= amount
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [per-bucket counts (the last is +Inf), sum]
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = []
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_label = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+metrics = {
+    "request_duration": Histogram("bananaphone_request_duration_seconds", "Time until the response starts, by endpoint.", latency_buckets, ("endpoint",)),
+    "completion_duration": Histogram("bananaphone_completion_duration_seconds", "Time until a completion has been fully relayed, by model.", latency_buckets, ("model", "stream")),
+    "time_to_first_token": Histogram("bananaphone_time_to_first_token_seconds", "Upstream time to the first streamed content, by model.", latency_buckets, ("model",)),
+    "inter_token_latency": Histogram("bananaphone_inter_token_latency_seconds", "Gap between streamed content events, by model.", (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5), ("model",)),
+    "tokens_per_second": Histogram("bananaphone_stream_tokens_per_second", "Streamed content events per second after the first, per stream, by model.", (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500), ("model",)),
+    "stage_duration": Histogram("bananaphone_stage_duration_seconds", "Time spent in relay stages such as autostyle and model resolution.", (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1), ("stage",)),
+    "requests": Counter("bananaphone_requests_total", "Requests handled, by endpoint and status code.", ("endpoint", "status")),
+    "in_flight": Gauge("bananaphone_requests_in_flight", "Requests currently being handled, including responses still streaming."),
+    "upstream_connections": Gauge("bananaphone_upstream_connections", "Upstream pool connections, by backend and state.", ("backend", "state")),
+    "upstream_queued": Gauge("bananaphone_upstream_queued_requests", "Requests waiting for an upstream pool connection, by backend.", ("backend",)),
+    "backend_outstanding": Gauge("bananaphone_backend_outstanding_requests", "Requests in progress on each backend.", ("backend",)),
+    "backend_healthy": Gauge("bananaphone_backend_healthy", "Whether each backend is in rotation.", ("backend",)),
+    "cache": Gauge("bananaphone_response_cache_events", "Response cache counters since startup.", ("event",)),
+    "coalescing": Gauge("bananaphone_coalescing_events", "Request coalescing counters since startup.", ("event",)),
+    "admission_active": Gauge("bananaphone_admission_active", "Generation slots in use, by API key.", ("key",)),
+    "admission_queued": Gauge("bananaphone_admission_queued", "Requests waiting for a generation slot, by API key.", ("key",)),
+    "admission_rejected": Gauge("bananaphone_admission_rejected", "Requests turned away by admission control since startup, by API key.", ("key",)),
+    "trimmed_messages": Counter("bananaphone_trimmed_messages_total", "Old conversation turns dropped to fit a model's context."),
+    "stops_enforced": Counter("bananaphone_stops_enforced_total", "Completions cut off at a stop sequence the backend didn't stop at.", ("stream",)),
+    "abandoned_generations": Counter("bananaphone_abandoned_generations_total", "Upstream generations cancelled because their client disconnected, by backend.", ("backend", "stream")),
+    "abandoned_seconds": Counter("bananaphone_abandoned_generation_seconds_total", "Backend time spent on generations before their clients disconnected.", ("backend", "stream")),
+    "reclaimed_seconds": Counter("bananaphone_reclaimed_generation_seconds_total", "Estimated backend time freed by cancelling abandoned generations, from each backend's typical generation time.", ("backend", "stream")),
+    "coalesced_events": Counter("bananaphone_stream_coalesced_events_total", "Streamed events sent in the same write as an earlier one, or combined into it."),
+    "embedding_batch_size": Histogram("bananaphone_embedding_batch_size", "Inputs sent upstream per embeddings call.", (1, 2, 4, 8, 16, 32, 64, 128, 256)),
+    "embeddings": Gauge("bananaphone_embedding_events", "Embeddings batching counters since startup.", ("event",)),
+}
+
+
+# Copy the state other components already keep into gauges, then render everything in the Prometheus text format.
+def render_metrics() -> str:
+    for base_url, stats in upstream_pool_stats().items():
+        for state in ("idle", "active"):
+            metrics["upstream_connections"].set(stats[state], base_url, state)
+        metrics["upstream_queued"].set(stats["queued_requests"], base_url)
+    for backend in backends:
+        metrics["backend_outstanding"].set(backend.outstanding, backend.url)
+        metrics["backend_healthy"].set(int(backend.healthy), backend.url)
+    if response_cache:
+        for event, count in response_cache.stats.items():
+            metrics["cache"].set(count, event)
+    if coalescer:
+        for event, count in coalescer.stats.items():
+            metrics["coalescing"].set(count, event)
+    for event, count in embedding_batcher.stats.items():
+        metrics["embeddings"].set(count, event)
+    if admission:
+        for key, state in admission.keys.items():
+            metrics["admission_active"].set(state.active, redact_key(key))
+            metrics["admission_queued"].set(len(state.waiters), redact_key(key))
+            metrics["admission_rejected"].set(state.rejected, redact_key(key))
+
+    lines = []
+    for metric in metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+################### LOGGING ###################
+# A compact record of one chat completion, logged as a single line when it finishes. It holds sizes, ids and timings, never
+# prompt text or whole API keys.
+class RequestSummary:
+    def __init__(self, request: Request):
+        self.id = request.headers.get("x-request-id") or uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.streaming = False  # Set once the response is handed off as a stream, which logs the summary when it ends
+        self.outcome = "error"
+        self.fields = {"id": self.id, "key": redact_key(client_key(request))}
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    # Hand the summary over to a response stream, which logs it once the stream ends.
+    def wrap_stream(self, stream):
+        self.streaming = True
+        return summarize_stream(stream, self)
+
+    def finish(self):
+        self.fields["outcome"] = self.outcome
+        self.fields["ms"] = round((time.perf_counter() - self.started) * 1000)
+        request_logger.info("%s", self)
+
+    def __str__(self) -> str:
+        return " ".join(f"{name}={value}" for name, value in self.fields.items() if value is not None)
+
+
+# Relay a response stream, noting its size and time to first byte, and log the request's summary once it ends.
+async def summarize_stream(stream, summary: RequestSummary):
+    bytes_out = 0
+    outcome = "error"
+    try:
+        async for chunk in stream:
+            if not bytes_out:
+                summary.set(ttfb_ms=round((time.perf_counter() - summary.started) * 1000))
+            bytes_out += len(chunk)
+            yield chunk
+        outcome = "ok"
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = "disconnected"
+        raise
+    finally:
+        summary.outcome = outcome
+        summary.set(bytes_out=bytes_out)
+        summary.finish()
+
+
+# Render a payload for the log, or None for the requests outside the LOG_PAYLOAD_SAMPLE. Message text is replaced with its
+# length under LOG_REDACT_PROMPTS, and the result is cut off at LOG_PAYLOAD_MAX_CHARS.
+def loggable_payload(payload: dict) -> Optional[str]:
+    if random.random() >= log_payload_sample or not logger.isEnabledFor(logging.INFO):
+        return None
+    if log_redact_prompts and payload.get('messages'):
+        payload = {**payload, 'messages': [{**message, 'content': f"<{len(str(message.get('content', '')))} chars>"} for message in payload['messages']]}
+    rendered = json.dumps(payload, ensure_ascii=False)
+    if len(rendered) > log_payload_max_chars:
+        rendered = f"{rendered[:log_payload_max_chars]}… ({len(rendered)} chars)"
+    return rendered
 
 
 ################### MIDDLEWARE ###################
@@ -74,6 +1236,9 @@ async def api_key_verification_middleware(request: Request, call_next):
     if request.method == "OPTIONS":
         return await call_next(request)
 
+    if request.url.path in PROBE_PATHS:
+        return await call_next(request)
+
     if api_key:  # Proceed only if API key(s) are set
         authorization: str = request.headers.get("Authorization")
         if authorization:
@@ -81,7 +1246,7 @@ async def api_key_verification_middleware(request: Request, call_next):
             if len(parts) == 2 and parts[0].lower() == 'bearer' and parts[1] in api_key:
                 return await call_next(request)
             else:
-                logger.warning(f"Invalid or missing API key. Received: {authorization}")
+                logger.warning("Invalid or missing API key. Received: %s", redact_key(parts[-1]) if parts else "(empty)")
                 return JSONResponse(
                     status_code=401,
                     content={
@@ -106,117 +1271,226 @@ async def api_key_verification_middleware(request: Request, call_next):
     return await call_next(request)
 
 
+# Count and time every request. Registered after the API key check, so it wraps it and sees rejected requests too.
+@api.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    metrics["in_flight"].inc()
+    started = time.perf_counter()
+    status = 500
+    body_wrapped = False
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.body_iterator = count_in_flight(response.body_iterator)  # Streams stay in flight until their last byte
+        body_wrapped = True
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", "other")  # Route templates, not raw paths, to keep label values bounded
+        metrics["request_duration"].observe(time.perf_counter() - started, endpoint)
+        metrics["requests"].inc(endpoint, status)
+        if not body_wrapped:
+            metrics["in_flight"].dec()
+
+
+# Pass a response body through, and count its request out of in_flight once the body ends, however it ends.
+async def count_in_flight(body):
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        metrics["in_flight"].dec()
+
+
 # Custom function to forward headers and include API key
-async def forward_request_with_api_key(url, method, data, headers):
-    headers_to_forward = {key: value for key, value in headers.items() if key.lower() in ['content-type']}
+async def forward_request_with_api_key(url, method, data: bytes, headers, backend: Backend = None):
+    headers_to_forward = {"content-type": "application/json"}
     if api_key:
         headers_to_forward["Authorization"] = f"Bearer {api_key}"
 
-    async with httpx.AsyncClient() as client:
-        response = await client.request(method, url, json=data, headers=headers_to_forward, timeout=timeout)
-        return response
+    backend = backend or backends[0]
+    client = get_upstream_client(backend.url)
+    started = time.perf_counter()
+    try:
+        async with backend.track() as responded:
+            response = await client.request(method, url, content=data, headers=headers_to_forward)
+            responded(response.status_code)
+    except asyncio.CancelledError:
+       # Cancelled because nobody's waiting for the response any more. Dropping the connection stops the generation.
+        backend.record_abandoned(time.perf_counter() - started, streaming=False)
+        raise
+    if response.status_code == 200:
+        backend.record_generation(time.perf_counter() - started)
+    return response
+
+
+# Wait for the client to go away. Only for use once the request body has been read, when the next ASGI message is the disconnect.
+async def wait_for_disconnect(request: Request):
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+# Await an upstream call, cancelling it if the client disconnects first, rather than letting it generate for nobody.
+async def cancel_on_disconnect(request: Request, call):
+    task = asyncio.ensure_future(call)
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task.done():
+        return task.result()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)  # Let the upstream request close before moving on
+    raise ClientDisconnected()
 
 
 ################### CORE ENDPOINTS ###################
-# The main attraction.
+# The main attraction. The body is decoded here rather than by FastAPI, so a request that needs no changes can be sent on
+# upstream byte for byte, and its response returned the same way.
 @api.post("/v1/chat/completions")
-async def chat_completions(data: dict, request: Request):
+async def chat_completions_endpoint(request: Request):
+    body = await request.body()
+    try:
+        data = json_loads(body)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {exc}")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="The request body must be a JSON object.")
+    return await chat_completions(data, request, body)
+
+
+# Relay a chat completion. Called with the raw request body from the endpoint, or with just a payload from the legacy
+# completions and batch endpoints, which get the completion back as a dict.
+async def chat_completions(data: dict, request: Request, body: bytes = None):
+    summary = RequestSummary(request)
+    slot = None  # An admission slot, held from acquire until it's released or handed over to the response stream
     try:
-        logger.info(f"Request for {data}")
-
         # Forward relevant headers
-        headers_to_forward = {key: value for key, value in request.headers.items() if key.lower() in ['content-type', 'authorization']}
+        headers_to_forward = {key: value for key, value in request.headers.items() if key.lower() in ['authorization']}
+        headers_to_forward['content-type'] = 'application/json'
+        passthrough = body is not None and not needs_rewrite(data)
         modified_data = data.copy()  # Create a shallow copy of data to avoid modifying the original data object
 
         is_streaming = modified_data.get("stream", False)
+        summary.set(model=modified_data.get('model'), stream=bool(is_streaming))
         
         modified_data.setdefault('temperature', 0.7)
 
         modified_data = replace_instructions_content_system(modified_data)
 
        # Check for empty messages and replace with a period
-        logger.info("Checking and modifying empty messages")
         messages = modified_data.get('messages', [])
         for message in messages:
             if 'content' in message and message['content'].strip() == '':
                 message['content'] = '.'
-        logger.info(f"Modified messages: {messages}")
+        summary.set(messages=len(messages), prompt_chars=sum(len(str(message.get('content', ''))) for message in messages))
+
 
+        # Route to a backend serving the requested model; autostyle then follows that backend's model
+        backend = select_backend(modified_data.get('model'))
+        summary.set(backend=backend.url)
 
         # Autostyle and format messages if enabled
+        model_config = None
         if autostyle:
-            modified_data['messages'] = await format_messages(modified_data.get('messages', []))
-
-            model_config = model_config_data.get(await fetch_active_model())
+            stage_started = time.perf_counter()
+            config_name = await fetch_active_model(backend, modified_data.get('model'))  # Resolved once per request and passed down
+            resolved_at = time.perf_counter()
+            metrics["stage_duration"].observe(resolved_at - stage_started, "model_resolution")
+            modified_data['messages'] = await format_messages(modified_data.get('messages', []), config_name)
+            metrics["stage_duration"].observe(time.perf_counter() - resolved_at, "autostyle")
+
+            model_config = model_index.configs.get(config_name)
             if model_config:
                 stops = model_config.get('stops', [])
                 modified_data['stop'] = stops
             else:
-                logger.error(f"No configuration found for model: {await fetch_active_model()}")
-                raise HTTPException(status_code=400, detail=f"No configuration found for model: {await fetch_active_model()}")
-
-        # Create an HTTP client
-        client = httpx.AsyncClient()
-        logger.info(f"Sending data to destination API: {modified_data}")
+                logger.error(f"No configuration found for model: {config_name}")
+                raise HTTPException(status_code=400, detail=f"No configuration found for model: {config_name}")
+
+        # Drop the oldest turns of a conversation too long for the model's context, leaving room for the reply
+        if 'messages' in modified_data:
+            modified_data['messages'], trimmed = trim_history(modified_data['messages'], modified_data.get('max_tokens'), model_config)
+            summary.set(trimmed=trimmed or None)
+
+        # Serve deterministic requests from the response cache when we've seen them before
+        cache_key = None
+        if response_cache and is_cacheable(modified_data):
+            cache_key = payload_key(modified_data, await resolve_model_id(backend, modified_data.get('model')))
+            cached_response = await response_cache.get(cache_key)
+            if cached_response is not None:
+                summary.set(cache="hit")
+                summary.outcome = "ok"
+                if is_streaming:
+                    return StreamingResponse(summary.wrap_stream(completion_to_sse(cached_response)), media_type="text/event-stream")
+                return cached_response
+
+        stops = stop_sequences(modified_data)
+
+        # Send the client's own bytes when nothing was changed, and re-encode only when something was
+        upstream_body = body if passthrough else json_bytes(modified_data)
+        summary.set(passthrough=passthrough or None, bytes_in=len(upstream_body))
+
+        # Wait for a generation slot, unless this request is about to share one that's already generating
+        coalesced = coalescer is not None and coalescer.in_flight(payload_key(modified_data), is_streaming)
+        summary.set(coalesced=coalesced or None)
+        if admission and not coalesced:
+            queued_at = time.perf_counter()
+            slot = await admission.acquire(client_key(request))
+            summary.set(queued_ms=round((time.perf_counter() - queued_at) * 1000))
+
+        payload_log = loggable_payload(modified_data)
+        if payload_log:
+            logger.info("Payload for request %s to %s: %s", summary.id, backend.url, payload_log)
 
         try:
             if is_streaming:
-               # Define a generator function to stream content from the destination API
-                async def content_generator():
-                   # Send the POST request to the destination API and stream the response
-                    async with client.stream('POST', f'{api_url}{endpoint_completions}', json=modified_data, headers=headers_to_forward, timeout=timeout) as response:
-                        logger.info(f"Received response from destination API: {response.status_code}")
-                       # Handle non-200 status codes
-                        if response.status_code != 200:
-                            await response.aread()  # read the response before accessing content
-                            yield f"Error: {response.content}".encode()
-                            return
-                       # Asynchronously iterate over the response text in chunks
-                        async for chunk in response.aiter_text():
-                            try:
-                               # Check for special 'data: [DONE]' chunk
-                                if chunk.strip() == 'data: [DONE]':
-                                    logger.info("Chunk stream completed.")
-                                    yield chunk.encode()
-                                    return
-
-                                json_data = json.loads(chunk.split('data: ', 1)[1])
-                                content_value = json_data.get('choices', [{}])[0].get('delta', {}).get('content', None)
-                                if content_value is not None:
-                                #   print(f"{json.dumps(json_data)}\n\n")
-                                    print(f"Received chunk from destination API, with this choices:delta:content: {content_value}")
-                                else:
-                                    print("Content key not found in the chunk.")
-       
-                                # Extract the JSON part from the chunk, assuming "data: " prefix is present
-                                json_str = chunk.split("data: ", 1)[1]
-                                # Parse the JSON string into a Python object
-                                chunk_dict = json.loads(json_str)
-                                # Remove folder paths and .bin from the "model" field
-                                chunk_dict['model'] = re.sub(r'.*\/([^/]+)\.bin$', r'\1', chunk_dict['model'])
-                                # Combine the "data: " prefix with the transformed JSON string
-                                transformed_chunk = "data: " + json.dumps(chunk_dict)
-
-                               # Yield each chunk to stream it to the client
-                                yield transformed_chunk.encode()
-
-                            except GeneratorExit:
-                               # Handle client disconnection
-                                logger.info("Client disconnected, closing stream.")
-                                return
-
-               # Return a StreamingResponse to stream the content to the client in real-time
-                return StreamingResponse(content_generator(), media_type="text/plain")
+               # Return a StreamingResponse to stream the content to the client in real-time. Stops are enforced on streams
+               # with one choice, which is all that local backends generate.
+                stream_stops = stops if (modified_data.get('n') or 1) == 1 else None
+                if coalescer:
+                    stream = coalescer.stream(payload_key(modified_data), lambda: relay_chat_stream(backend, upstream_body, headers_to_forward, stream_stops))
+                else:
+                    stream = relay_chat_stream(backend, upstream_body, headers_to_forward, stream_stops)
+                if stream_coalesce_window > 0:
+                    stream = coalesce_sse(stream, stream_coalesce_window, stream_coalesce_bytes, stream_coalesce_mode == "combine")
+                if slot:
+                    stream, slot = admission.hold(slot, stream), None  # The stream releases it when it ends
+                return StreamingResponse(summary.wrap_stream(stream), media_type="text/event-stream")
 
             else:
-                response = await forward_request_with_api_key(f'{api_url}{endpoint_completions}', 'POST', modified_data, request.headers)
+                send = lambda: forward_request_with_api_key(f'{backend.url}{endpoint_completions}', 'POST', upstream_body, request.headers, backend)
+                started = time.perf_counter()
+                try:
+                    response = await cancel_on_disconnect(request, coalescer.call(payload_key(modified_data), send) if coalescer else send())
+                except ClientDisconnected:
+                    summary.outcome = "disconnected"
+                    return {"error": "The client disconnected."}
+                finally:
+                    if slot:
+                        admission.release(slot)
+                        slot = None
                 
                 # Check for an error within the response content
-                response_json = response.json()
+                response_json = json_loads(response.content)
+                summary.set(status=response.status_code)
                 if 'error' in response_json:
                     return {"error": response_json['error']}
+                truncated = stops is not None and truncate_at_stops(response_json, stops)
+                summary.outcome = "ok"
+                summary.set(completion_tokens=(response_json.get('usage') or {}).get('completion_tokens'))
+                backend.active_model.observe(response_json.get('model'))
+                metrics["completion_duration"].observe(time.perf_counter() - started, model_basename(response_json.get('model') or "unknown"), "false")
+                if cache_key and response.status_code == 200:
+                    await response_cache.put(cache_key, response_json)
                 
-               # Return the JSON response directly
+               # Return the JSON response directly, as the upstream's own bytes when answering the endpoint
+                if body is not None and not truncated:
+                    return Response(content=response.content, status_code=response.status_code, media_type="application/json")
                 return response_json
 
         except asyncio.TimeoutError:
@@ -229,10 +1503,20 @@ async def chat_completions(data: dict, request: Request):
             logger.error(f"Exception occurred: {e}")
             return {"error": str(e)}
 
+    except AdmissionRejected:
+        summary.outcome = "rejected"
+        raise
+
     except Exception as exc:
         logger.error(f"Error processing request: {exc}\n{traceback.format_exc()}")
         raise HTTPException(status_code=400, detail=str(exc))
 
+    finally:
+        if slot:
+            admission.release(slot)  # Whatever went wrong, don't keep the slot from the next request
+        if not summary.streaming:
+            summary.finish()
+
 
 # Send messages out to the destination API / LM Studio
 async def send_request(client: httpx.AsyncClient, method: str, url: str, **kwargs):
@@ -245,17 +1529,19 @@ async def send_request(client: httpx.AsyncClient, method: str, url: str, **kwarg
     return Response(content=json.dumps(content), media_type=response.headers.get('content-type'), status_code=response.status_code)
 
 # Check which model is running, then applies the relevant formatting for that model
-async def format_messages(messages: list) -> list:
-    model_config = model_config_data.get(await fetch_active_model())
+async def format_messages(messages: list, config_name: str = None) -> list:
+    if config_name is None:
+        config_name = await fetch_active_model()
+    model_config = model_index.configs.get(config_name)
     if model_config:
-        logger.info(f"Model configuration found: {model_config}")
+        logger.debug("Model configuration found: %s", model_config)
         user_prefix = model_config['prefix']
         user_suffix = model_config['suffix']
         system_prefix = model_config.get('sysPrefix', '')
         system_suffix = model_config.get('sysSuffix', '')
 
         if messages:
-            logger.info(f"Formatting {len(messages)} messages")
+            logger.debug("Formatting %d messages", len(messages))
 
             for i, msg in enumerate(messages):
                 if msg.get('role') == 'user':
@@ -272,18 +1558,18 @@ async def format_messages(messages: list) -> list:
 
         return messages
     else:
-        error_message = f"No configuration found for model: {await fetch_active_model()}"
+        error_message = f"No configuration found for model: {config_name}"
         logger.error(error_message)
         raise HTTPException(status_code=400, detail=error_message)
 
 @api.options("/v1/chat/completions")
 async def relay_options_for_chat_completions(request: Request):
-    async with httpx.AsyncClient() as client:
-        response = await client.request(
-            method=request.method,
-            url=f"{api_url}/v1/chat/completions",
-            headers=request.headers
-        )
+    backend = select_backend()
+    response = await get_upstream_client(backend.url).request(
+        method=request.method,
+        url=f"{backend.url}/v1/chat/completions",
+        headers=request.headers
+    )
     return Response(
         content=response.content,
         status_code=response.status_code,
@@ -293,43 +1579,104 @@ async def relay_options_for_chat_completions(request: Request):
 # This is included for legacy compatibility with older clients. 
 @api.post("/v1/completions")
 async def completions(request_model: CompletionsRequest, request: Request):
-    print(request_model)
    # Reformatting the request payload to match the /v1/chat/completions endpoint
-    chat_completions_payload = {
+    chat_completions_payload = request_model.model_dump(exclude_none=True, exclude={'prompt'})
+    chat_completions_payload.update({
         "messages": [
             {
                 "role": "user",
                 "content": request_model.prompt
             }
         ],
-        "max_tokens": request_model.max_tokens if request_model.max_tokens > 0 else -1,
-        "stream": False
-    }
+        "max_tokens": request_model.max_tokens if request_model.max_tokens and request_model.max_tokens > 0 else -1,
+        "stream": request_model.stream
+    })
 
     # Directly call the existing /v1/chat/completions endpoint function
-    chat_response = await chat_completions(chat_completions_payload, request)#
+    chat_response = await chat_completions(chat_completions_payload, request)
+
+    # Streamed chat deltas are translated into text_completion chunks as they arrive
+    if isinstance(chat_response, StreamingResponse):
+        return StreamingResponse(chat_sse_to_completion_sse(chat_response.body_iterator), media_type="text/event-stream")
+    if 'error' in chat_response:
+        return chat_response
 
     # Extracting and reformatting the relevant data
     formatted_response = {
         "id": chat_response['id'].replace('chatcmpl', 'cmpl'),
         "object": "text_completion",
         "created": chat_response['created'],
-        "model": chat_response['model'].split('/')[-1].split('.')[0], # Extract model name from path
+        "model": legacy_model_name(chat_response['model']),
         "choices": [
             {
-                "text": chat_response['choices'][0]['message']['content'],
-                "index": chat_response['choices'][0]['index'],
+                "text": choice['message']['content'],
+                "index": choice['index'],
                 "logprobs": None,
-                "finish_reason": chat_response['choices'][0]['finish_reason']
+                "finish_reason": choice['finish_reason']
             }
+            for choice in chat_response['choices']
         ],
-        "usage": chat_response['usage']
+        "usage": chat_response.get('usage')
     }
 
    # Returning the response to the requester
     return formatted_response
 
 
+# Run a JSONL file of chat completions. Each line is {"custom_id": ..., "body": {chat payload}}, or a bare chat payload.
+# Results stream back as JSONL in the order lines finish, each tagged with its line number and custom_id.
+# Pass ?offset=N to skip the first N lines, e.g. to resume a batch that was cut off.
+@api.post("/v1/batch")
+async def batch(request: Request, offset: int = Query(0, ge=0)):
+    import tempfile  # Only batches need it
+
+   # Spool the whole upload to disk before running any of it, so a large batch never sits in memory. Results start
+   # streaming back once the upload is complete.
+    spool = tempfile.TemporaryFile()
+    try:
+        async for chunk in request.stream():
+            await asyncio.to_thread(spool.write, chunk)
+        await asyncio.to_thread(spool.seek, 0)
+    except BaseException:
+        spool.close()
+        raise
+    return StreamingResponse(run_batch(spool, offset, request), media_type="application/x-ndjson")
+
+
+# Embeddings. Text inputs go through the batcher, sharing upstream calls with concurrent requests; anything else, like
+# token arrays, is sent on as it is.
+@api.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.body()
+    try:
+        data = json_loads(body)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {exc}")
+    if not isinstance(data, dict) or 'input' not in data:
+        raise HTTPException(status_code=400, detail="The request body must be a JSON object with an 'input'.")
+
+    model = data.get('model')
+    texts = [data['input']] if isinstance(data['input'], str) else data['input']
+    try:
+        if not isinstance(texts, list) or not texts or not all(isinstance(text, str) for text in texts):
+            return await relay_embeddings(body, model)
+        options = {field: value for field, value in data.items() if field not in ('input', 'model', 'user')}
+        results = await embedding_batcher.embed(model, options, texts)
+    except UpstreamError as exc:
+        return Response(content=exc.content, status_code=exc.status_code, media_type="application/json")
+    except (httpx.HTTPError, KeyError, TypeError, ValueError) as exc:
+        logger.error(f"Embeddings request failed: {exc!r}")
+        return JSONResponse(status_code=502, content={"error": {"code": "upstream_error", "message": f"The destination API failed to embed the input: {exc!r}"}})
+
+    prompt_tokens = sum(tokens for _, tokens, _ in results)
+    return {
+        "object": "list",
+        "data": [{"object": "embedding", "index": index, "embedding": vector} for index, (vector, _, _) in enumerate(results)],
+        "model": results[0][2],
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
 ################### ACTIVE HELPERS ###################
 # Add the relevant 'stop' commands to message payloads
 def apply_stops(data: dict, stops: list) -> dict:
@@ -337,6 +1684,18 @@ def apply_stops(data: dict, stops: list) -> dict:
         data["stop"] = stops
     return data
 
+# Whether chat_completions would change anything in a payload before sending it on: autostyle, a missing temperature,
+# a system message to add or override, or an empty message to fill in. If not, the request can be passed through untouched.
+def needs_rewrite(data: dict) -> bool:
+    if autostyle or 'temperature' not in data:
+        return True
+    messages = data.get('messages') or []
+    if messages and (messages[0].get('role') != 'system' or system_override):
+        return True
+    if any(not isinstance(message.get('content', '-'), str) or not message.get('content', '-').strip() for message in messages):
+        return True
+    return trim_history(messages, data.get('max_tokens'), None, dry_run=True)[1] > 0
+
 # Replace the system message the system prompt
 def replace_instructions_content_system(data: dict) -> dict:
     messages = data.get('messages', [])
@@ -357,6 +1716,577 @@ def replace_instructions_content_system(data: dict) -> dict:
     return data
 
 
+################### CONTEXT WINDOW ###################
+# Counts tokens in message text: exactly with a tokenizer, remembering counts by content hash so the earlier turns of a
+# growing conversation aren't tokenized again on every request, or else estimated from the length, which needs no memory.
+class TokenCounter:
+    def __init__(self, chars_per_token: float, tokenizer: str = None):
+        self.chars_per_token = chars_per_token
+        self.tokenizer = load_tokenizer(tokenizer) if tokenizer else None
+        self._counts = OrderedDict()  # content hash -> tokens
+
+    def count(self, text: str) -> int:
+        if self.tokenizer is None:
+            return math.ceil(len(text) / self.chars_per_token)
+        key = hashlib.sha1(text.encode()).digest()
+        tokens = self._counts.get(key)
+        if tokens is None:
+            tokens = self._counts[key] = len(self.tokenizer.encode(text).ids)
+            if len(self._counts) > token_cache_size:
+                self._counts.popitem(last=False)
+        else:
+            self._counts.move_to_end(key)
+        return tokens
+
+    # Tokens for a whole message, allowing a few for its role markers. Content given as parts counts its text parts.
+    def count_message(self, message: dict) -> int:
+        content = message.get('content') or ''
+        if not isinstance(content, str):
+            content = ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+        return self.count(content) + 4
+
+
+def load_tokenizer(path: str):
+    try:
+        from tokenizers import Tokenizer  # Optional; exact token counts for configs that name a tokenizer.json
+    except ImportError:
+        logger.warning(f"Install the tokenizers package to count tokens with {path}; estimating from characters per token instead.")
+        return None
+    try:
+        return Tokenizer.from_file(path)
+    except Exception as e:
+        logger.error(f"Could not load tokenizer {path}; estimating from characters per token instead: {e}")
+        return None
+
+
+@lru_cache(maxsize=32)
+def token_counter(chars_per_token: float, tokenizer: str = None) -> TokenCounter:
+    return TokenCounter(chars_per_token, tokenizer)
+
+# The context length and token counter for a models.json config, falling back to CONTEXT_LENGTH and CHARS_PER_TOKEN.
+def context_limits(model_config: Optional[dict]) -> tuple:
+    model_config = model_config or {}
+    counter = token_counter(float(model_config.get('charsPerToken', chars_per_token)), model_config.get('tokenizer'))
+    return int(model_config.get('contextLength', default_context_length)), counter
+
+# Drop the oldest turns of a conversation until it fits the model's context with room for the reply: max_tokens, or
+# CONTEXT_RESERVE when that isn't set. System messages and the latest message are always kept, and the history left never
+# starts on an assistant reply. Returns the messages and how many were dropped; a dry run only counts them.
+def trim_history(messages: list, max_tokens, model_config: Optional[dict], dry_run: bool = False) -> tuple:
+    context_length, counter = context_limits(model_config)
+    if not context_length or len(messages) < 2:
+        return messages, 0
+    budget = context_length - (max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else context_reserve)
+    sizes = [counter.count_message(message) for message in messages]
+    total = sum(sizes)
+    if total <= budget:
+        return messages, 0
+
+    keep = [True] * len(messages)
+    dropped = 0
+    for index in range(len(messages) - 1):
+        role = messages[index].get('role')
+        if role == 'system':
+            continue
+        if total <= budget and not (dropped and role == 'assistant'):
+            break
+        keep[index] = False
+        total -= sizes[index]
+        dropped += 1
+    if dry_run:
+        return messages, dropped
+
+    if total > budget:
+        logger.warning(f"Prompt is still about {total} tokens after trimming, over the {budget} token budget.")
+    if dropped:
+        metrics["trimmed_messages"].inc(amount=dropped)
+        logger.info(f"Dropped the {dropped} oldest messages to fit a {context_length} token context.")
+    return [message for message, kept in zip(messages, keep) if kept], dropped
+
+
+################### STOP SEQUENCES ###################
+# A request's stop sequences, compiled once and shared between requests: a regex that finds the earliest stop in a text,
+# and every proper prefix of every stop, to tell how much of a text's end could still grow into one.
+class StopSequences:
+    def __init__(self, stops: tuple):
+        self.pattern = re.compile('|'.join(re.escape(stop) for stop in sorted(stops, key=len, reverse=True)))
+        self.prefixes = {stop[:end] for stop in stops for end in range(1, len(stop))}
+        self.longest_prefix = max(len(stop) for stop in stops) - 1
+
+    # Where the first stop in a text starts, or -1.
+    def find(self, text: str) -> int:
+        match = self.pattern.search(text)
+        return match.start() if match else -1
+
+    # How many characters at the end of a text are the start of a stop.
+    def partial_suffix(self, text: str) -> int:
+        for length in range(min(len(text), self.longest_prefix), 0, -1):
+            if text[-length:] in self.prefixes:
+                return length
+        return 0
+
+
+# Incremental stop matching for streamed text. Each piece of text fed in comes back minus any end that might be the start
+# of a stop, which is held back until the next piece shows whether it is; at the first stop, everything after is dropped.
+class StopMatcher:
+    def __init__(self, sequences: StopSequences):
+        self.sequences = sequences
+        self.pending = ''
+        self.stopped = False
+
+    def feed(self, text: str) -> str:
+        text = self.pending + text
+        index = self.sequences.find(text)
+        if index >= 0:
+            self.stopped = True
+            self.pending = ''
+            return text[:index]
+        held = self.sequences.partial_suffix(text)
+        self.pending = text[len(text) - held:] if held else ''
+        return text[:len(text) - held]
+
+    # Release held back text once the completion has ended without reaching a stop.
+    def flush(self) -> str:
+        text, self.pending = self.pending, ''
+        return text
+
+
+@lru_cache(maxsize=64)
+def compile_stops(stops: tuple) -> StopSequences:
+    return StopSequences(stops)
+
+# The stop sequences to enforce for a payload, or None if it has none or ENFORCE_STOPS is off. A 'stop' that's neither a
+# string nor a list isn't enforced here; it's sent on for the backend to judge.
+def stop_sequences(payload: dict) -> Optional[StopSequences]:
+    stops = payload.get('stop')
+    if isinstance(stops, str):
+        stops = [stops]
+    elif not isinstance(stops, list):
+        return None
+    stops = tuple(stop for stop in stops or () if isinstance(stop, str) and stop)
+    return compile_stops(stops) if enforce_stops and stops else None
+
+# Cut each choice of a finished completion at its first stop sequence. Returns whether any were cut.
+def truncate_at_stops(completion: dict, stops: StopSequences) -> bool:
+    truncated = False
+    for choice in completion.get('choices') or ():
+        message = choice.get('message') or {}
+        content = message.get('content')
+        index = stops.find(content) if isinstance(content, str) else -1
+        if index >= 0:
+            message['content'] = content[:index]
+            choice['finish_reason'] = 'stop'
+            truncated = True
+    if truncated:
+        metrics["stops_enforced"].inc("false")
+    return truncated
+
+
+################### STREAMING HELPERS ###################
+# Stream a chat completion from a backend, relaying each SSE event to the client as it arrives. With stop sequences, the
+# stream is cut off at the first one and the upstream request is dropped, so the backend stops generating.
+async def relay_chat_stream(backend: Backend, body: bytes, headers: dict, stops: StopSequences = None):
+    client = get_upstream_client(backend.url)
+    raw_model = relay_model = None
+    metric_model = "unknown"
+    event_count = 0
+    started = time.perf_counter()
+    first_token_at = last_token_at = None
+    token_events = 0
+    stop_matcher = StopMatcher(stops) if stops else None
+    last_chunk = None
+   # Send the POST request to the destination API and stream the response
+    async with backend.track() as responded, client.stream('POST', f'{backend.url}{endpoint_completions}', content=body, headers=headers) as response:
+        responded(response.status_code)
+        logger.debug("Received response from destination API: %s", response.status_code)
+       # Handle non-200 status codes
+        if response.status_code != 200:
+            await response.aread()  # read the response before accessing content
+            yield sse_error_event(response)
+            return
+        try:
+           # Reassemble whole SSE events, however the upstream bytes happen to be chunked
+            async for data, raw in iter_sse_events(response.aiter_bytes()):
+                if data is None:
+                    yield raw + b'\n\n'  # Comments and other events without data pass through untouched
+                    continue
+
+               # Check for the special 'data: [DONE]' event
+                if data.strip() == b'[DONE]':
+                    logger.debug("Chunk stream completed.")
+                    if stop_matcher and stop_matcher.pending and last_chunk:
+                        yield chunk_like(last_chunk, relay_model, {'content': stop_matcher.flush()}, None)
+                    backend.record_generation(time.perf_counter() - started)
+                    record_stream_metrics(metric_model, started, first_token_at, last_token_at, token_events)
+                    yield b'data: [DONE]\n\n'
+                    return
+
+                try:
+                    chunk_dict = json_loads(data)
+                except ValueError:
+                    logger.warning(f"Relaying undecodable event from destination API: {data[:200]!r}")
+                    yield raw + b'\n\n'
+                    continue
+
+               # The model is constant for the whole stream, so only work out its relay name when it changes
+                model = chunk_dict.get('model')
+                if model != raw_model:
+                    if raw_model is None:
+                        backend.active_model.observe(model)
+                    raw_model, relay_model = model, strip_model_path(model)
+                    metric_model = model_basename(model) if model else "unknown"
+
+               # Time each event carrying content, for time-to-first-token and inter-token latency
+                choices = chunk_dict.get('choices')
+                if choices and choices[0].get('delta', {}).get('content'):
+                    now = time.perf_counter()
+                    if first_token_at is None:
+                        first_token_at = now
+                        metrics["time_to_first_token"].observe(now - started, metric_model)
+                    else:
+                        metrics["inter_token_latency"].observe(now - last_token_at, metric_model)
+                    last_token_at = now
+                    token_events += 1
+
+                event_count += 1
+                if stream_debug_hooks and event_count % max(1, stream_debug_sample) == 0:
+                    for hook in stream_debug_hooks:
+                        hook(chunk_dict)
+
+               # Enforce stop sequences here as well, since not every backend does, and a stop can arrive split across events
+                if stop_matcher and choices:
+                    last_chunk = chunk_dict
+                    choice = choices[0]
+                    delta = choice.get('delta') or {}
+                    content = delta.get('content') or ''
+                    text = stop_matcher.feed(content)
+                    if stop_matcher.stopped:
+                        if text:
+                            yield chunk_like(chunk_dict, relay_model, {**delta, 'content': text}, None)
+                        yield chunk_like(chunk_dict, relay_model, {}, 'stop')
+                        yield b'data: [DONE]\n\n'
+                        metrics["stops_enforced"].inc("true")
+                        record_stream_metrics(metric_model, started, first_token_at, last_token_at, token_events)
+                        return  # Leaving the upstream stream's context drops the connection, which stops the generation
+                    if choice.get('finish_reason'):
+                        text += stop_matcher.flush()
+                    if text != content:
+                        if text or choice.get('finish_reason') or len(delta) > 1:
+                            yield chunk_like(chunk_dict, relay_model, {**delta, 'content': text}, choice.get('finish_reason'))
+                        continue
+
+               # Relay the upstream bytes as-is, unless the model field needs its folder path and .bin removed
+                if relay_model == raw_model:
+                    yield raw + b'\n\n'
+                else:
+                    chunk_dict['model'] = relay_model
+                    yield b'data: ' + json_bytes(chunk_dict) + b'\n\n'
+
+        except (GeneratorExit, asyncio.CancelledError):
+           # Handle client disconnection. Leaving the upstream stream's context closes its connection, which stops the generation.
+            logger.debug("Client disconnected, closing stream.")
+            backend.record_abandoned(time.perf_counter() - started, streaming=True)
+            raise
+
+
+# Build a streamed chat event like `template`, with the given delta and finish reason for its one choice.
+def chunk_like(template: dict, model: str, delta: dict, finish_reason: Optional[str]) -> bytes:
+    choice = {**template['choices'][0], 'delta': delta, 'finish_reason': finish_reason}
+    return b'data: ' + json_bytes({**template, 'model': model, 'choices': [choice]}) + b'\n\n'
+
+
+# Hold streamed events back for up to `window` seconds, or until `max_bytes` of them are waiting, and send them on in one
+# write, so a stream of tiny deltas doesn't cost a socket write per token. The first event, [DONE], errors and finish
+# events go out straight away, along with anything held back before them. With `combine`, consecutive content deltas
+# are also joined into a single event.
+async def coalesce_sse(stream, window: float, max_bytes: int, combine: bool = False):
+    pending = asyncio.Queue(maxsize=256)
+    end = object()
+
+   # Read the source in its own task, so a write is never later than the window however long the upstream goes quiet
+    async def pump():
+        try:
+            async for event in stream:
+                await pending.put(event)
+            await pending.put(end)
+        except Exception as exc:
+            await pending.put(exc)
+
+    pump_task = asyncio.create_task(pump())
+    loop = asyncio.get_running_loop()
+    first = True
+    try:
+        while True:
+            item = await pending.get()
+            held = []
+            size = 0
+            deadline = loop.time() + window
+            while True:
+                if item is end or isinstance(item, Exception):
+                    break
+                held.append(item)
+                size += len(item)
+                if size >= max_bytes:
+                    item = None
+                    break
+                if first or is_urgent_event(item):
+                    deadline = 0  # Send now, with just the events already waiting behind this one
+                if pending.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        item = None
+                        break
+                    try:
+                        item = await asyncio.wait_for(pending.get(), remaining)
+                    except asyncio.TimeoutError:
+                        item = None
+                        break
+                else:
+                    item = pending.get_nowait()
+
+            if held:
+                first = False
+                metrics["coalesced_events"].inc(amount=len(held) - 1)
+                yield combine_sse_events(held) if combine and len(held) > 1 else b''.join(held)
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+    finally:
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)  # Let the upstream request close before moving on
+
+
+# Events that shouldn't wait for company: [DONE], errors, anything that isn't a data event, and finish events.
+def is_urgent_event(event: bytes) -> bool:
+    if not event.startswith(b'data: {') or event.startswith(b'data: {"error"'):
+        return True
+    return b'"finish_reason"' in event and b'"finish_reason":null' not in event and b'"finish_reason": null' not in event
+
+
+# Join each run of plain content deltas into one event, built on the run's last event and keeping the first one's role.
+# Any other event passes through untouched.
+def combine_sse_events(events: list) -> bytes:
+    out = []
+    run = []  # (event bytes, decoded chunk) pairs
+
+    def end_run():
+        if len(run) == 1:
+            out.append(run[0][0])
+        elif run:
+            delta = {**run[0][1]['choices'][0]['delta'], 'content': ''.join(chunk['choices'][0]['delta']['content'] for _, chunk in run)}
+            out.append(chunk_like(run[-1][1], run[-1][1].get('model'), delta, None))
+        run.clear()
+
+    for event in events:
+        delta = None
+        try:
+            chunk = json_loads(event[6:]) if event.startswith(b'data: {') else None
+            choice = chunk['choices'][0] if len(chunk['choices']) == 1 else None
+            delta = choice['delta'] if not choice.get('finish_reason') else None
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            pass
+        if not isinstance(delta, dict) or not isinstance(delta.get('content'), str) or not set(delta) <= {'role', 'content'}:
+            end_run()
+            out.append(event)
+            continue
+        if run and ('role' in delta or choice.get('index') != run[0][1]['choices'][0].get('index')):
+            end_run()
+        run.append((event, chunk))
+    end_run()
+    return b''.join(out)
+
+
+def record_stream_metrics(model: str, started: float, first_token_at: float, last_token_at: float, token_events: int):
+    metrics["completion_duration"].observe(time.perf_counter() - started, model, "true")
+    if token_events > 1 and last_token_at > first_token_at:
+        metrics["tokens_per_second"].observe((token_events - 1) / (last_token_at - first_token_at), model)
+
+
+# Split an upstream byte stream into SSE events, however the bytes happen to be chunked. Yields (data, raw) pairs: data is
+# the event's joined data: lines (None if it has none), and raw is the event's bytes without the trailing blank line.
+async def iter_sse_events(byte_stream):
+    buffer = b''
+    async for chunk in byte_stream:
+        buffer += chunk
+        if b'\r' in buffer:
+            buffer = buffer.replace(b'\r\n', b'\n')
+        start = 0
+        while True:
+            end = buffer.find(b'\n\n', start)
+            if end < 0:
+                break
+            if end > start:
+                raw = buffer[start:end]
+                yield parse_sse_data(raw), raw
+            start = end + 2
+        buffer = buffer[start:]
+
+    if buffer.strip():
+        raw = buffer.rstrip(b'\n')
+        yield parse_sse_data(raw), raw
+
+
+def parse_sse_data(raw: bytes) -> Optional[bytes]:
+    if raw.startswith(b'data: ') and b'\n' not in raw:
+        return raw[6:]  # The usual case: one data line per event
+    lines = [line[5:].removeprefix(b' ') for line in raw.split(b'\n') if line.startswith(b'data:')]
+    return b'\n'.join(lines) if lines else None
+
+
+# Relay an upstream error status to a streaming client as an SSE event, keeping the upstream error body when it's JSON.
+def sse_error_event(response: httpx.Response) -> bytes:
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or 'error' not in body:
+        body = {"error": {"message": response.text, "code": response.status_code}}
+    return b'data: ' + json_bytes(body) + b'\n\n'
+
+
+# Replay a complete chat completion as an SSE stream: a content chunk and a finish chunk per choice, then [DONE].
+async def completion_to_sse(completion: dict):
+    base = {"id": completion.get("id"), "object": "chat.completion.chunk", "created": completion.get("created"), "model": strip_model_path(completion.get("model"))}
+    for choice in completion.get("choices", []):
+        message = choice.get("message", {})
+        delta = {"role": message.get("role", "assistant"), "content": message.get("content", "")}
+        yield b'data: ' + json_bytes({**base, "choices": [{"index": choice.get("index", 0), "delta": delta, "finish_reason": None}]}) + b'\n\n'
+        yield b'data: ' + json_bytes({**base, "choices": [{"index": choice.get("index", 0), "delta": {}, "finish_reason": choice.get("finish_reason")}]}) + b'\n\n'
+    yield b'data: [DONE]\n\n'
+
+
+# Translate a chat completion SSE stream into the legacy text_completion stream format, event by event.
+async def chat_sse_to_completion_sse(chat_stream):
+    async for data, raw in iter_sse_events(chat_stream):
+        if data is None or data.strip() == b'[DONE]':
+            yield raw + b'\n\n'
+            continue
+        try:
+            chunk = json_loads(data)
+        except ValueError:
+            yield raw + b'\n\n'
+            continue
+        if 'choices' not in chunk:
+            yield raw + b'\n\n'  # Errors pass through as they are
+            continue
+
+        choices = [
+            {
+                "text": choice.get('delta', {}).get('content') or "",
+                "index": choice.get('index', 0),
+                "logprobs": None,
+                "finish_reason": choice.get('finish_reason')
+            }
+            for choice in chunk['choices']
+        ]
+        choices = [choice for choice in choices if choice['text'] or choice['finish_reason']]  # Skip role-only deltas
+        if choices:
+            completion_chunk = {"id": (chunk.get('id') or '').replace('chatcmpl', 'cmpl'), "object": "text_completion", "created": chunk.get('created'), "model": legacy_model_name(chunk.get('model') or ''), "choices": choices}
+            yield b'data: ' + json_bytes(completion_chunk) + b'\n\n'
+
+
+# Extract the model name from a path, as the legacy completions endpoint reports it
+def legacy_model_name(model: str) -> str:
+    return model.split('/')[-1].split('.')[0]
+
+
+# Remove folder paths and .bin from a model name
+def strip_model_path(model: str) -> str:
+    return model_path_regex.sub(r'\1', model) if model else model
+
+
+def log_stream_event(chunk_dict: dict):
+    content_value = chunk_dict.get('choices', [{}])[0].get('delta', {}).get('content')
+    logger.debug("Received chunk from destination API, with this choices:delta:content: %r", content_value)
+
+if stream_debug_sample > 0:
+    stream_debug_hooks.append(log_stream_event)
+
+
+################### BATCH HELPERS ###################
+# Read a spooled batch a block at a time, yielding (line number, line) for each non-blank line.
+async def iter_batch_lines(spool):
+    line_number = 0
+    while True:
+        lines = await asyncio.to_thread(spool.readlines, 1 << 20)
+        if not lines:
+            return
+        for line in lines:
+            if line.strip():
+                yield line_number, line
+            line_number += 1
+
+# Run the lines of a batch concurrently, reading the next line only once a slot frees up, and yield each result as it finishes.
+async def run_batch(spool, offset: int, request: Request):
+    pending = set()
+    done = failed = 0
+    started = time.monotonic()
+
+    def finish(task) -> bytes:
+        nonlocal done, failed
+        result = task.result()
+        done += 1
+        failed += 'error' in result
+        if done % 100 == 0:
+            logger.info(f"Batch progress: {done} lines done ({failed} failed), {len(pending)} in flight, {time.monotonic() - started:.1f}s elapsed.")
+        return json_bytes(result) + b'\n'
+
+    try:
+        async for line_number, line in iter_batch_lines(spool):
+            if line_number < offset:
+                continue
+            while len(pending) >= batch_concurrency * max(1, sum(backend.healthy for backend in backends)):
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    yield finish(task)
+            pending.add(asyncio.create_task(run_batch_line(line_number, line, request)))
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                yield finish(task)
+        logger.info(f"Batch finished: {done} lines done ({failed} failed) in {time.monotonic() - started:.1f}s.")
+    finally:
+       # If the client goes away mid-batch, stop the lines still running
+        for task in pending:
+            task.cancel()
+        spool.close()
+
+# Run one line of a batch through the chat completions endpoint, retrying failures with backoff.
+async def run_batch_line(line_number: int, line: bytes, request: Request) -> dict:
+    result = {"line": line_number, "custom_id": None}
+    error = None
+    for attempt in range(batch_retries + 1):
+        delay = batch_retry_backoff * 2 ** attempt
+        try:
+           # Parse afresh each attempt, since the endpoint rewrites the messages it's given
+            item = json_loads(line)
+            if not isinstance(item, dict) or not isinstance(item.get('body', {}), dict):
+                raise ValueError("each line must be a JSON object, with any body also an object")
+            result["custom_id"] = item.get('custom_id')
+            payload = item['body'] if 'body' in item else {key: value for key, value in item.items() if key != 'custom_id'}
+            payload['stream'] = False
+            response = await chat_completions(payload, request)
+            if 'error' not in response:
+                result["response"] = response
+                return result
+            error = response['error']
+        except (ValueError, TypeError) as exc:
+            result["error"] = f"Invalid batch line: {exc}"
+            return result
+        except AdmissionRejected as exc:
+            error = exc.detail
+            delay = max(delay, float(exc.headers["Retry-After"]))
+        except HTTPException as exc:
+            result["error"] = exc.detail
+            return result
+        if attempt < batch_retries:
+            logger.warning(f"Batch line {line_number} failed ({error}); retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+    result["error"] = error
+    return result
+
+
 ################### PASSIVE HELPERS ###################
 # Dependency to verify the API key
 async def verify_api_key(authorization: Optional[str] = Header(None)):
@@ -378,76 +2308,147 @@ async def verify_api_key(authorization: Optional[str] = Header(None)):
         return
 
 
-# This active model is needed to for autostyle to function.
-async def fetch_active_model():
-    api_url_with_protocol = 'http://' + api_url if not api_url.startswith(('http://', 'https://')) else api_url
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f'{api_url_with_protocol}/v1/models')
-            response.raise_for_status()  # Raises an HTTPError for bad responses (4xx and 5xx)
-            active_model_id = json.loads(response.content)["data"][0]["id"]
-            logger.info(f"Active model ID fetched: {active_model_id}")
-        except httpx.HTTPError as http_err:
-            logger.error(f"HTTP error occurred: {http_err}")
-            return "default"  # Return the default configuration key on error
-        except KeyError as key_err:
-            logger.error(f"Key error in parsing response: {key_err}")
-            return "default"  # Return the default configuration key on error
-        except json.JSONDecodeError as json_err:
-            logger.error(f"JSON decode error: {json_err}")
-            return "default"  # Return the default configuration key on error
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            return "default"  # Return the default configuration key on error
+# This active model is needed to for autostyle to function. Returns the config name for a backend: the requested model's,
+# if the backend serves it, and otherwise that of the backend's active model (served from its active model cache).
+async def fetch_active_model(backend: Backend = None, requested_model: str = None):
+    backend = backend or backends[0]
+    if requested_model and backend.serves(requested_model):
+        return match_model_config(requested_model)
+    return await backend.active_model.get()
+
+
+# Compare model ids regardless of folder paths and .bin suffixes, which differ between /v1/models and completions.
+def model_basename(model_id: str) -> str:
+    return re.sub(r'\.bin$', '', model_id).rsplit('/', 1)[-1]
+
+
+# Find the models.json configuration whose shortnames match the active model id.
+def match_model_config(active_model_id: str) -> str:
+    return model_index.match(active_model_id)
+
+
+# Reload models.json if it changed since it was last loaded (or always, when forced). A broken file is logged and skipped,
+# leaving the previous configuration in place. Returns True if a new configuration was swapped in.
+def reload_model_config(force: bool = False) -> bool:
+    global model_index
+    try:
+        mtime = os.path.getmtime(models_path)
+    except OSError as e:
+        logger.error(f"Could not check {models_path} for changes: {e}")
+        return False
+    if not force and mtime == model_index.mtime:
+        return False
+
+    try:
+        new_index = ModelConfigIndex.from_file(models_path)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not reload {models_path}; keeping the previous configuration: {e}")
+        model_index.mtime = mtime  # Don't retry the same broken file every interval
+        return False
+
+    compile_model_configs(new_index)
+    model_index = new_index
+    logger.info(f"Reloaded {models_path}: {len(new_index.configs)} configurations, {len(new_index.shortnames)} model names.")
+    return True
+
+
+# Build the stop matchers and token counters the configurations use, so no request has to wait for them.
+def compile_model_configs(index: ModelConfigIndex):
+    for config_data in index.configs.values():
+        stop_sequences({'stop': config_data.get('stops')})
+        context_limits(config_data)
+
+
+# Get ready for the first requests: compile models.json, open connections to each backend and resolve their active models,
+# so the first request takes the warm path. /readyz answers 503 until this is done.
+async def warm_up():
+    global warmed_up
+    started = time.perf_counter()
+    compile_model_configs(model_index)
+    await asyncio.gather(*(warm_backend(backend) for backend in backends))
+    warmed_up = True
+    reachable = sum(1 for backend in backends if backend_reachable(backend))
+    logger.info(f"Warmed up in {time.perf_counter() - started:.2f}s; {reachable} of {len(backends)} backends reachable.")
 
-        for config_name, config_data in model_config_data.items():
-            for model_name in config_data.get('models', []):
-                if model_name in active_model_id:
-                    logger.info(f"Match found for model '{model_name}' under configuration '{config_name}'")
-                    return config_name
 
-        logger.warning(f"Model name {active_model_id} does not match any configuration. Using default.")
-        return "default"  # Return the default configuration key if no match found
+# Resolve a backend's active model, with extra requests alongside it so the pool keeps WARMUP_CONNECTIONS connections open.
+async def warm_backend(backend: Backend):
+    client = get_upstream_client(backend.url)
+    extra = (client.get(f'{backend.url}{endpoint_models}', timeout=discovery_timeout) for _ in range(warmup_connections - 1))
+    await asyncio.gather(backend.active_model.refresh(), *extra, return_exceptions=True)
+
+
+# Whether a backend answered its last models check.
+def backend_reachable(backend: Backend) -> bool:
+    return bool(backend.models) and backend.failures == 0
+
+
+# Poll models.json for changes so edits apply without restarting the server.
+async def watch_model_config():
+    while True:
+        await asyncio.sleep(models_reload_interval)
+        reload_model_config()
 
 
 # Query the available models on the destination API. For LM Studio, it will only return the active model.
 @api.get("/v1/models")
 async def models():
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f'{api_url}{endpoint_models}', timeout=30.0)
-           # Print the response content to debug the issue
-            print("Response content:", response.content)
-            
-           # Update the "id" value in the response
-            data = json.loads(response.content)
-            data["data"][0]["id"] = re.sub(r'.*\/([^/]+)\.bin$', r'\1', data["data"][0]["id"])
-            
-           # Convert the updated data back to a JSON string
-            modified_data = json.dumps(data)
+    try:
+        # Ask every healthy backend, and merge their model lists
+        live_backends = [backend for backend in backends if backend.healthy] or backends
+        responses = await asyncio.gather(*(get_upstream_client(backend.url).get(f'{backend.url}{endpoint_models}', timeout=30.0) for backend in live_backends), return_exceptions=True)
+
+        data = None
+        seen = set()
+        for backend, response in zip(live_backends, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Error retrieving models from {backend.url}: {response!r}")
+                continue
+            if response.status_code != 200:
+                logger.error(f"Error retrieving models from {backend.url}: status {response.status_code}")
+                continue
+           # One backend's bad answer leaves its routing table as it was, and the others' models still get listed
+            try:
+                backend_models = json_loads(response.content)["data"]
+                model_ids = [model["id"] for model in backend_models]
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Unexpected model list from {backend.url}: {e!r}")
+                continue
+            backend.set_models(model_ids)
+            if data is None:
+                data = {"object": "list", "data": []}
+           # Update the "id" values in the response
+            for model in backend_models:
+                model["id"] = strip_model_path(model["id"])
+                if model["id"] not in seen:
+                    seen.add(model["id"])
+                    data["data"].append(model)
+
+        if data is None:
+            raise httpx.HTTPError("No backend returned a model list.")
+
+        logger.debug(f"backends: {[backend.url for backend in live_backends]}")
+        logger.debug(f"endpoint_models: {endpoint_models}")
+        return data
 
-            logger.debug(f"api_url: {api_url}")
-            logger.debug(f"endpoint_models: {endpoint_models}")
-            return json.loads(modified_data)
+    except httpx.HTTPError:
+        logger.error("Error retrieving models from destination API.")
+        return {"error": "Failed to retrieve models from the destination API."}
 
-        except httpx.HTTPError:
-            logger.error("Error retrieving models from destination API.")
-            return {"error": "Failed to retrieve models from the destination API."}
-
-        except Exception as e:
-           # Handle exceptions or errors that may occur during the request
-            print("Request error:", str(e))
-            return {"error": f"Request error: {str(e)}"}
+    except Exception as e:
+       # Handle exceptions or errors that may occur during the request
+        logger.error("Request error: %s", e)
+        return {"error": f"Request error: {str(e)}"}
 
 
 @api.options("/v1/models")
-async def relay_options_for_models():
-    async with httpx.AsyncClient() as client:
-        response = await client.request(
-            method=request.method,
-            url=f"{api_url}/v1/chat/completions",
-            headers=request.headers
-        )
+async def relay_options_for_models(request: Request):
+    backend = select_backend()
+    response = await get_upstream_client(backend.url).request(
+        method=request.method,
+        url=f"{backend.url}{endpoint_models}",
+        headers=request.headers
+    )
     return Response(
         content=response.content,
         status_code=response.status_code,
@@ -457,14 +2458,14 @@ async def relay_options_for_models():
 
 @api.get("/favicon.ico")
 async def favicon():
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f'{api_url}/favicon.ico', timeout=30.0)
-           # Check if the response is not empty (you may need to adjust the condition depending on the API)
-            if response.status_code == 200 and response.content:
-                return Response(response.content, media_type=response.headers.get('content-type'), status_code=response.status_code)
-        except httpx.HTTPError:
-            logger.error("Error retrieving favicon from destination API. Using local fallback.")
+    try:
+        backend = select_backend()
+        response = await get_upstream_client(backend.url).get(f'{backend.url}/favicon.ico', timeout=30.0)
+       # Check if the response is not empty (you may need to adjust the condition depending on the API)
+        if response.status_code == 200 and response.content:
+            return Response(response.content, media_type=response.headers.get('content-type'), status_code=response.status_code)
+    except httpx.HTTPError:
+        logger.error("Error retrieving favicon from destination API. Using local fallback.")
     
     return FileResponse("favicon.ico")
 
@@ -474,6 +2475,69 @@ async def get_completions (data: dict, request: Request):
     return request 
 
 
+# Connection pool statistics for each upstream backend client.
+@api.get("/pool")
+async def pool_stats():
+    return upstream_pool_stats()
+
+
+# Prometheus metrics.
+@api.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+# Admission control state: slots in use and queued requests per API key, or null if admission control is off.
+@api.get("/admission")
+async def admission_stats():
+    return admission.status() if admission else None
+
+
+# Request coalescing counters, or null if coalescing is off.
+@api.get("/coalescing")
+async def coalescing_stats():
+    return coalescer.status() if coalescer else None
+
+
+# Response cache hit/miss counters, or null if the cache is off.
+@api.get("/cache")
+async def cache_stats():
+    return response_cache.status() if response_cache else None
+
+
+# Routing and health state of each backend.
+@api.get("/backends")
+async def backend_status():
+    return [backend.status() for backend in backends]
+
+
+# Liveness: the process is up and answering.
+@api.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+# Readiness: warmed up, with models.json compiled and at least one backend reachable. Send traffic only once this is 200.
+@api.get("/readyz")
+async def readyz():
+    if warmed_up and not any(backend_reachable(backend) for backend in backends):
+        # Check the backends again now, rather than waiting for the next health check, but don't keep the probe waiting
+        await asyncio.wait([asyncio.ensure_future(backend.active_model.refresh()) for backend in backends], timeout=2)
+    reachable = [backend.url for backend in backends if backend_reachable(backend)]
+    ready = warmed_up and bool(reachable)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "warmed_up": warmed_up, "configurations": len(model_index.configs), "reachable_backends": reachable},
+    )
+
+
+# Reload models.json now, without waiting for the file watcher.
+@api.post("/admin/reload-models")
+async def reload_models():
+    reloaded = reload_model_config(force=True)
+    return {"reloaded": reloaded, "configurations": len(model_index.configs), "models": len(model_index.shortnames)}
+
+
 @api.head("/")
 async def read_root():
     return {}
@@ -500,6 +2564,20 @@ async def unexpected_endpoint_error_handler(request: Request, exc: UnexpectedEnd
     )
 
 
+@api.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={
+            "error": {
+                "code": "rate_limit_exceeded",
+                "message": exc.detail
+            }
+        },
+        headers=exc.headers,
+    )
+
+
 @api.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
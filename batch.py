@@ -0,0 +1,120 @@
+################### Banana phone batch runner 🍌 📦 ###################
+# Send a JSONL file of chat completions to a running Banana phone's /v1/batch endpoint, and write the results as JSONL.
+#
+#   python batch.py prompts.jsonl -o results.jsonl
+#   python batch.py prompts.jsonl -o results.jsonl --resume   # pick up where an interrupted run left off
+#
+# Each input line is {"custom_id": ..., "body": {chat payload}}, or a bare chat payload. Lines without a custom_id are given
+# one from their line number in the input file, so every result can be matched back to its prompt.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path='.env')
+
+
+# Collect the custom_ids that already have a response in the output file, so a resumed run can skip them. A last line
+# cut off by the interruption is dropped, so the resumed results start on a fresh line.
+def completed_ids(output_path: str) -> set:
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as output:
+        complete_bytes = 0
+        for line in output:
+            if not line.endswith(b'\n'):
+                break
+            complete_bytes += len(line)
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if 'response' in result:
+                done.add(result.get('custom_id'))
+        output.truncate(complete_bytes)
+    return done
+
+
+# Read the input file a line at a time, tagging lines with a custom_id where needed and skipping any already done. The
+# original line number of each line sent is appended to `sent`, so results can be matched back to the input file.
+# Lines that can't carry a custom_id (invalid JSON, or JSON that isn't an object) are sent as they are, for the server to
+# report back on, except when resuming: their earlier results can't be told apart, so they're skipped rather than repeated.
+async def iter_lines(input_path: str, skip: set, sent: list, resuming: bool = False):
+    with open(input_path, 'rb') as source:
+        for line_number, line in enumerate(source):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                item = None
+            if not isinstance(item, dict):
+                if not resuming:
+                    sent.append(line_number)
+                    yield line.rstrip(b'\r\n') + b'\n'
+                continue
+            if item.get('custom_id') is None:
+                item['custom_id'] = f"line-{line_number}"
+            if item['custom_id'] not in skip:
+                sent.append(line_number)
+                yield json.dumps(item).encode() + b'\n'
+
+
+async def count_lines(input_path: str, skip: set, resuming: bool) -> int:
+    return sum([1 async for _ in iter_lines(input_path, skip, [], resuming)])
+
+
+async def run(args):
+    skip = completed_ids(args.output) if args.resume else set()
+    total = await count_lines(args.input, skip, args.resume)
+    if skip:
+        print(f"Resuming: {len(skip)} lines already done, {total} to go.", file=sys.stderr)
+    if not total:
+        print("Nothing to do.", file=sys.stderr)
+        return 0
+
+    headers = {"Authorization": f"Bearer {args.key}"} if args.key else {}
+    done = failed = 0
+    sent = []  # Original line numbers, in the order the lines were sent
+    started = time.monotonic()
+    async with httpx.AsyncClient(timeout=httpx.Timeout(connect=30, read=None, write=120, pool=5)) as client:
+        async with client.stream('POST', f"{args.url.rstrip('/')}/v1/batch", content=iter_lines(args.input, skip, sent, args.resume), headers=headers) as response:
+            if response.status_code != 200:
+                await response.aread()
+                print(f"Batch rejected ({response.status_code}): {response.text}", file=sys.stderr)
+                return 1
+            with open(args.output, 'ab' if args.resume else 'wb') as output:
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    if isinstance(result.get('line'), int) and result['line'] < len(sent):
+                        result['line'] = sent[result['line']]  # The server counts lines of what it was sent, not of the input file
+                    output.write(json.dumps(result).encode() + b'\n')
+                    output.flush()  # Keep the output file resumable at every line
+                    done += 1
+                    failed += 'error' in result
+                    print(f"\r{done}/{total} done, {failed} failed, {time.monotonic() - started:.0f}s", end='', file=sys.stderr)
+    print(file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of chat completions through Banana phone's /v1/batch endpoint.")
+    parser.add_argument("input", help="JSONL file of chat completion requests")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file to write results to (default: results.jsonl)")
+    parser.add_argument("--url", default=f"http://localhost:{os.getenv('LOCAL_PORT', '3456')}", help="Banana phone address")
+    parser.add_argument("--key", default=os.getenv('API_KEYS', '').split(',')[0], help="API key (default: the first of API_KEYS)")
+    parser.add_argument("--resume", action="store_true", help="Append to the output file, skipping lines it already has a response for")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
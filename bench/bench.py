@@ -0,0 +1,320 @@
+################### Banana phone relay benchmark 🍌 ⏱️ ###################
+# Measure what Banana phone itself adds on top of the destination API. Starts the mock upstream (mock_upstream.py) and the
+# real BananaPhone:api app, then sends the same load straight to the mock and through the relay, streamed and not, with
+# autostyle on and off. Reports the latency and time-to-first-token the relay adds, streamed events per second, and the
+# relay's CPU time and memory per stream, and writes it all as JSON for comparing releases.
+#
+#   python bench/bench.py --requests 500 --concurrency 32 --output bench-results.json
+#   python bench/bench.py --compare bench-results.json   # run again, and show how the relay's overhead changed
+#
+# CPU and memory figures are read from /proc, so they're only reported on Linux.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BENCH_KEY = "banana-bench"
+
+
+################### SERVERS ###################
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app: str, app_dir: str, port: int, env: dict, quiet: bool = False) -> subprocess.Popen:
+    command = [sys.executable, "-m", "uvicorn", app, "--app-dir", app_dir, "--port", str(port)]
+    if quiet:
+        command += ["--no-access-log", "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=REPO_DIR, env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def wait_until_ready(url: str, process: subprocess.Popen, headers: dict = None, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server for {url} exited with code {process.returncode}.")
+            try:
+                if (await client.get(url, headers=headers)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Server for {url} wasn't ready after {timeout}s.")
+
+
+# CPU seconds used and resident memory of a process, from /proc. None where /proc isn't available.
+def process_stats(pid: int) -> Optional[dict]:
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/status") as status:
+            rss_kb = next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+        return {"cpu_seconds": (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), "rss_bytes": rss_kb * 1024}
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+
+################### LOAD ###################
+def percentile(values: list, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def milliseconds(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+# Send one chat completion and time it. For streams, time to first token is the time to the first data event.
+async def timed_request(client: httpx.AsyncClient, url: str, headers: dict, payload: dict) -> dict:
+    started = time.perf_counter()
+    first_event_at = None
+    events = 0
+    try:
+        if payload["stream"]:
+            async with client.stream("POST", url, json=payload, headers=headers) as response:
+                ok = response.status_code == 200
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:") or line == "data: [DONE]":
+                        continue
+                    if first_event_at is None:
+                        first_event_at = time.perf_counter()
+                    ok = ok and '"error"' not in line
+                    events += 1
+        else:
+            response = await client.post(url, json=payload, headers=headers)
+            ok = response.status_code == 200 and "error" not in response.json()
+    except httpx.HTTPError:
+        ok = False
+    finished = time.perf_counter()
+    return {"ok": ok, "latency": finished - started, "ttft": first_event_at - started if first_event_at else None, "events": events}
+
+
+# Send `requests` chat completions to a URL, `concurrency` at a time, and summarize how they went.
+async def run_load(url: str, headers: dict, stream: bool, requests: int, concurrency: int, max_tokens: int) -> dict:
+    results = []
+    indexes = iter(range(requests))
+
+    async def worker(client: httpx.AsyncClient):
+        for index in indexes:
+            payload = {
+                "messages": [
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": f"Benchmark prompt number {index}. Please reply with some tokens."},
+                ],
+                "max_tokens": max_tokens,
+                "temperature": 0.7,
+                "stream": stream,
+            }
+            results.append(await timed_request(client, url, headers, payload))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120)) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+
+    succeeded = [result for result in results if result["ok"]]
+    latencies = [result["latency"] for result in succeeded]
+    ttfts = [result["ttft"] for result in succeeded if result["ttft"] is not None]
+    events = sum(result["events"] for result in succeeded)
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "seconds": round(wall, 3),
+        "requests_per_second": round(len(succeeded) / wall, 2),
+        "latency_p50_ms": milliseconds(percentile(latencies, 0.5)),
+        "latency_p99_ms": milliseconds(percentile(latencies, 0.99)),
+        "ttft_p50_ms": milliseconds(percentile(ttfts, 0.5)),
+        "ttft_p99_ms": milliseconds(percentile(ttfts, 0.99)),
+        "events_per_second": round(events / wall, 1) if stream else None,
+    }
+
+
+def difference(relay: Optional[float], direct: Optional[float]) -> Optional[float]:
+    return None if relay is None or direct is None else round(relay - direct, 3)
+
+
+# Run one scenario: the same load straight to the mock upstream, then through the relay, watching the relay process.
+async def run_scenario(args, mock_url: str, relay_url: str, relay: subprocess.Popen, autostyle: bool, stream: bool) -> dict:
+    load = dict(stream=stream, requests=args.requests, concurrency=args.concurrency, max_tokens=args.tokens)
+    relay_headers = {"Authorization": f"Bearer {BENCH_KEY}"}
+    for url, headers in ((mock_url, {}), (relay_url, relay_headers)):
+        await run_load(url, headers, **{**load, "requests": args.warmup})
+
+    direct = await run_load(mock_url, {}, **load)
+
+    before = process_stats(relay.pid)
+    peak_rss = before["rss_bytes"] if before else None
+
+    async def watch_memory():
+        nonlocal peak_rss
+        while True:
+            stats = process_stats(relay.pid)
+            if stats:
+                peak_rss = max(peak_rss or 0, stats["rss_bytes"])
+            await asyncio.sleep(0.05)
+
+    watcher = asyncio.create_task(watch_memory())
+    try:
+        relayed = await run_load(relay_url, relay_headers, **load)
+    finally:
+        watcher.cancel()
+    after = process_stats(relay.pid)
+
+    process = None
+    if before and after:
+        process = {
+            "cpu_ms_per_request": round((after["cpu_seconds"] - before["cpu_seconds"]) * 1000 / args.requests, 3),
+            "rss_before_bytes": before["rss_bytes"],
+            "rss_peak_bytes": peak_rss,
+            "rss_per_stream_bytes": round((peak_rss - before["rss_bytes"]) / args.concurrency),
+        }
+    return {
+        "autostyle": autostyle,
+        "stream": stream,
+        "direct": direct,
+        "relay": relayed,
+        "overhead": {metric: difference(relayed[metric], direct[metric]) for metric in ("latency_p50_ms", "latency_p99_ms", "ttft_p50_ms", "ttft_p99_ms")},
+        "relay_process": process,
+    }
+
+
+################### REPORTING ###################
+def scenario_name(scenario: dict) -> str:
+    return f"{'stream' if scenario['stream'] else 'non-stream'}, autostyle {'on' if scenario['autostyle'] else 'off'}"
+
+
+def print_report(results: dict, baseline: Optional[dict]):
+    previous = {scenario_name(scenario): scenario for scenario in (baseline or {}).get("scenarios", [])}
+    for scenario in results["scenarios"]:
+        name = scenario_name(scenario)
+        direct, relayed, overhead, process = scenario["direct"], scenario["relay"], scenario["overhead"], scenario["relay_process"]
+        print(f"\n{name}")
+        print(f"  direct:   p50 {direct['latency_p50_ms']} ms, p99 {direct['latency_p99_ms']} ms, {direct['requests_per_second']} req/s, {direct['errors']} errors")
+        print(f"  relayed:  p50 {relayed['latency_p50_ms']} ms, p99 {relayed['latency_p99_ms']} ms, {relayed['requests_per_second']} req/s, {relayed['errors']} errors")
+        print(f"  overhead: p50 {overhead['latency_p50_ms']} ms, p99 {overhead['latency_p99_ms']} ms", end="")
+        if scenario["stream"]:
+            print(f", TTFT p50 {overhead['ttft_p50_ms']} ms, p99 {overhead['ttft_p99_ms']} ms; {relayed['events_per_second']} events/s relayed ({direct['events_per_second']} direct)", end="")
+        print()
+        if process:
+            print(f"  relay:    {process['cpu_ms_per_request']} CPU ms per request, {process['rss_per_stream_bytes'] / 1024:.1f} KiB per concurrent request, {process['rss_peak_bytes'] / 1048576:.1f} MiB peak RSS")
+        if name in previous:
+            old = previous[name]["overhead"]
+            print(f"  vs {baseline.get('label') or 'baseline'}: overhead p50 {difference(overhead['latency_p50_ms'], old['latency_p50_ms']):+} ms, p99 {difference(overhead['latency_p99_ms'], old['latency_p99_ms']):+} ms")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    mock_port, relay_port = free_port(), free_port()
+    mock_env = {
+        "MOCK_TOKENS": str(args.tokens),
+        "MOCK_TOKENS_PER_SECOND": str(args.tokens_per_second),
+        "MOCK_CHUNK_TOKENS": str(args.chunk_tokens),
+        "MOCK_LATENCY": str(args.latency),
+        "MOCK_ERROR_RATE": str(args.error_rate),
+    }
+    # Features that would change what's measured (caching identical prompts, queuing, sharing generations) stay off,
+    # whatever the local .env says
+    relay_env = {
+        "DESTINATION_API": f"http://127.0.0.1:{mock_port}",
+        "API_KEYS": BENCH_KEY,
+        "RESPONSE_CACHE": "false",
+        "COALESCE_REQUESTS": "false",
+        "MAX_CONCURRENT": "0",
+        "MAX_CONCURRENT_PER_KEY": "0",
+        "RATE_LIMIT_RPS": "0",
+    }
+    mock_url = f"http://127.0.0.1:{mock_port}/v1/chat/completions"
+    relay_url = f"http://127.0.0.1:{relay_port}/v1/chat/completions"
+
+    results = {
+        "label": args.label or git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "label")},
+        "scenarios": [],
+    }
+
+    mock = start_server("mock_upstream:app", BENCH_DIR, mock_port, mock_env, quiet=True)
+    try:
+        await wait_until_ready(f"http://127.0.0.1:{mock_port}/v1/models", mock)
+        for autostyle in args.autostyle:
+            relay = start_server("BananaPhone:api", REPO_DIR, relay_port, {**relay_env, "AUTOSTYLE": str(autostyle).lower()})
+            try:
+                await wait_until_ready(f"http://127.0.0.1:{relay_port}/readyz", relay)  # Warmed up, so the first measured request is too
+                for stream in args.stream:
+                    print(f"Running {args.requests} requests, {args.concurrency} at a time: {scenario_name({'stream': stream, 'autostyle': autostyle})}", file=sys.stderr)
+                    results["scenarios"].append(await run_scenario(args, mock_url, relay_url, relay, autostyle, stream))
+            finally:
+                stop_server(relay)
+    finally:
+        stop_server(mock)
+
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"\nResults written to {args.output}", file=sys.stderr)
+
+
+def on_off(value: str) -> list:
+    return [choice.strip() in ("on", "true", "stream") for choice in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the latency and resources Banana phone adds on top of a mock destination API.")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario (default: 200)")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once (default: 16)")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before each scenario (default: 20)")
+    parser.add_argument("--stream", type=on_off, default=[True, False], help="which modes to run: stream, nostream, or both comma-separated (default: both)")
+    parser.add_argument("--autostyle", type=on_off, default=[True, False], help="autostyle settings to run: on, off, or both comma-separated (default: both)")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per completion (default: 64)")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="mock generation rate per request; 0 for as fast as possible (default: 200)")
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="tokens per streamed event (default: 1)")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock seconds before the first token (default: 0.05)")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of mock completions that fail with a 500 (default: 0)")
+    parser.add_argument("--label", help="name for this run in the results, e.g. a release (default: the git revision)")
+    parser.add_argument("--output", default="bench-results.json", help="JSON file for the results (default: bench-results.json; empty to skip)")
+    parser.add_argument("--compare", help="earlier results JSON to compare the relay's overhead against")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+################### Mock upstream for benchmarks 🍌 🧪 ###################
+# A stand-in for LM Studio Server, serving /v1/models and /v1/chat/completions with canned tokens at a steady rate, so the
+# relay's own cost can be measured without a real model in the way. Used by bench.py, or run it on its own:
+#
+#   python -m uvicorn mock_upstream:app --app-dir bench --port 1234
+#
+# It's configured through environment variables:
+#   MOCK_MODEL              model id to report (default matches the Alpaca configuration in models.json)
+#   MOCK_TOKENS             tokens per completion, unless the request's max_tokens asks for fewer (default 64)
+#   MOCK_TOKENS_PER_SECOND  generation rate; 0 sends tokens as fast as possible (default 200)
+#   MOCK_CHUNK_TOKENS       tokens per streamed event (default 1)
+#   MOCK_LATENCY            seconds before the first token, like prompt processing (default 0.05)
+#   MOCK_ERROR_RATE         fraction of completions answered with a 500 error, from 0 to 1 (default 0)
+
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+mock_model = os.getenv("MOCK_MODEL", "bench/openhermes-2.5-mistral-7b.Q4_K_M.gguf")
+mock_tokens = int(os.getenv("MOCK_TOKENS", 64))
+mock_tokens_per_second = float(os.getenv("MOCK_TOKENS_PER_SECOND", 200))
+mock_chunk_tokens = max(1, int(os.getenv("MOCK_CHUNK_TOKENS", 1)))
+mock_latency = float(os.getenv("MOCK_LATENCY", 0.05))
+mock_error_rate = float(os.getenv("MOCK_ERROR_RATE", 0))
+
+app = FastAPI()
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": mock_model, "object": "model", "owned_by": "bench"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if random.random() < mock_error_rate:
+        return JSONResponse(status_code=500, content={"error": {"message": "Injected mock error.", "type": "server_error"}})
+
+    max_tokens = body.get("max_tokens") or 0
+    tokens = max(1, min(mock_tokens, max_tokens) if max_tokens > 0 else mock_tokens)
+    completion_id = f"chatcmpl-{random.getrandbits(48):x}"
+    created = int(time.time())
+
+    if body.get("stream"):
+        return StreamingResponse(stream_tokens(completion_id, created, tokens), media_type="text/event-stream")
+
+    await asyncio.sleep(mock_latency + (tokens / mock_tokens_per_second if mock_tokens_per_second else 0))
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": mock_model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "tok " * tokens}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": len(json.dumps(body.get("messages", []))) // 4, "completion_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+# Send the completion a chunk of tokens at a time, paced to MOCK_TOKENS_PER_SECOND.
+async def stream_tokens(completion_id: str, created: int, tokens: int):
+    await asyncio.sleep(mock_latency)
+    started = time.perf_counter()
+    for sent in range(0, tokens, mock_chunk_tokens):
+        if mock_tokens_per_second:
+            # Sleep until this chunk is due, so per-event overhead doesn't slow the overall rate
+            delay = started + sent / mock_tokens_per_second - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": mock_model,
+            "choices": [{"index": 0, "delta": {"content": "tok " * min(mock_chunk_tokens, tokens - sent)}, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n".encode()
+    chunk["choices"] = [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    yield f"data: {json.dumps(chunk)}\n\n".encode()
+    yield b"data: [DONE]\n\n"
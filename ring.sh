@@ -45,7 +45,7 @@ pip list
 
 # Install or update dependencies
 echo "Installing/Updating dependencies..."
-pip install fastapi uvicorn httpx pytz pydantic python-dotenv h2
+pip install fastapi uvicorn httpx pydantic python-dotenv h2 orjson
 pip install 'httpx[http2]'
 
 UVICORN_BIN=$(which uvicorn || echo "uvicorn")